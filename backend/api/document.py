@@ -1,35 +1,50 @@
 import os
 import json
 import uuid
-from datetime import datetime
+from typing import Optional
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from models.schema import DocumentInfo
 import config
-from services.extract_service import extract_text
-from services.clean_service import clean_text
-from services.chunk_service import chunk_text, count_tokens
-from services.embedding_service import generate_embeddings
-from services.milvus_service import insert_chunks, delete_doc_chunks, get_doc_chunks
+from services.milvus_service import delete_doc_chunks, get_doc_chunks, resolve_collection
+from services.rate_limit_service import ProviderRateLimitError
+from services import state_service, dedup_service, ingest_service
+from api.kb import get_kb_or_404
 
 router = APIRouter(prefix="/api/document", tags=["document"])
 
 # 分块结果存储目录
-CHUNK_RESULTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "chunk_results")
+CHUNK_RESULTS_DIR = config.CHUNK_RESULTS_DIR
 os.makedirs(CHUNK_RESULTS_DIR, exist_ok=True)
 
-# 内存中维护文档列表（生产环境应使用数据库）
-_documents: dict[str, DocumentInfo] = {}
+
+def _get_document(doc_id: str) -> DocumentInfo | None:
+    """从共享注册表读取文档信息（多 worker 一致）"""
+    data = state_service.get_document(doc_id)
+    return DocumentInfo(**data) if data else None
 
 
 @router.post("/upload")
 async def upload_document(
     file: UploadFile = File(...),
-    chunk_mode: str = Form("sliding"),
-    chunk_size: int = Form(500),
-    overlap: int = Form(100),
-    model_provider: str = Form("openai"),
+    chunk_mode: Optional[str] = Form(None),
+    chunk_size: Optional[int] = Form(None),
+    overlap: Optional[int] = Form(None),
+    model_provider: Optional[str] = Form(None),
+    kb: Optional[str] = Form(None),
 ):
-    """上传文档并处理"""
+    """上传文档并处理；指定 kb 时写入该知识库，未显式传入的分块参数取知识库配置"""
+    # 未传入的参数取知识库配置或全局默认值
+    defaults = {"chunk_mode": "sliding", "chunk_size": config.DEFAULT_CHUNK_SIZE, "overlap": config.DEFAULT_OVERLAP}
+    if kb:
+        kb_info = get_kb_or_404(kb)
+        defaults.update(chunk_mode=kb_info.chunk_mode, chunk_size=kb_info.chunk_size, overlap=kb_info.overlap)
+        # 知识库的 collection 绑定 provider
+        model_provider = kb_info.model_provider
+    chunk_mode = chunk_mode or defaults["chunk_mode"]
+    chunk_size = chunk_size if chunk_size is not None else defaults["chunk_size"]
+    overlap = overlap if overlap is not None else defaults["overlap"]
+    model_provider = model_provider or "openai"
+
     # 参数校验
     if chunk_size < 50 or chunk_size > 5000:
         raise HTTPException(status_code=400, detail="chunk_size 应在 50-5000 之间")
@@ -53,71 +68,58 @@ async def upload_document(
     with open(save_path, "wb") as f:
         f.write(content)
 
-    # 2. 抽取文本
-    raw_text = extract_text(save_path, file_ext)
-
-    # 3. 清洗文本
-    cleaned = clean_text(raw_text)
-
-    if not cleaned.strip():
-        raise HTTPException(status_code=400, detail="文档内容为空")
-
-    # 4. 分块
-    chunks = await chunk_text(
-        cleaned,
-        mode=chunk_mode,
-        chunk_size=chunk_size,
-        overlap=overlap,
-        model_provider=model_provider,
-    )
-
-    if not chunks:
-        raise HTTPException(status_code=400, detail="文档内容为空，无法分块")
-
-    # 5. 生成 embedding
-    vectors = await generate_embeddings(chunks, model_provider=model_provider)
-
-    # 6. 写入 Milvus
-    insert_chunks(doc_id, chunks, vectors, model_provider=model_provider)
-
-    # 7. 保存分块结果到文件
-    _save_chunk_results(
+    # 2-9. 抽取、清洗、分块、近重复检测、embedding、写入 Milvus，各阶段 / 批次均有断点
+    ingest_service.create_job(
         doc_id=doc_id,
         filename=filename,
-        chunks=chunks,
-        vectors=vectors,
+        file_ext=file_ext,
+        save_path=save_path,
         chunk_mode=chunk_mode,
         chunk_size=chunk_size,
         overlap=overlap,
         model_provider=model_provider,
+        kb=kb,
     )
-
-    # 8. 记录文档信息
-    doc_info = DocumentInfo(
-        doc_id=doc_id,
-        filename=filename,
-        chunk_count=len(chunks),
-        status="completed",
-        model_provider=model_provider,
-        chunk_mode=chunk_mode,
-        chunk_size=chunk_size,
-        overlap=overlap,
-    )
-    _documents[doc_id] = doc_info
-
-    return {
-        "doc_id": doc_id,
-        "filename": filename,
-        "chunk_count": len(chunks),
-        "status": "completed",
-        "model_provider": model_provider,
-    }
+    return await _run_ingest(doc_id)
+
+
+async def _run_ingest(doc_id: str) -> dict:
+    try:
+        return await ingest_service.run_job(doc_id)
+    except ingest_service.IngestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ingest_service.IngestBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="入库任务不存在")
+    except Exception as e:
+        # 断点已保留，可通过 resume 接口从中断处继续
+        status_code = 429 if isinstance(e, ProviderRateLimitError) else 500
+        raise HTTPException(
+            status_code=status_code,
+            detail=f"文档 {doc_id} 处理中断: {e}；可调用 POST /api/document/{doc_id}/resume 从断点继续",
+        )
+
+
+@router.post("/{doc_id}/resume")
+async def resume_document(doc_id: str):
+    """从断点继续处理失败 / 中断的文档（已完成的抽取、分块、embedding 批次和写入不会重复执行）"""
+    return await _run_ingest(doc_id)
+
+
+@router.get("/{doc_id}/ingest")
+async def get_ingest_progress(doc_id: str):
+    """查看文档入库进度（处理完成后断点会被删除）"""
+    job = ingest_service.load_job(doc_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="入库任务不存在或已完成")
+    return job
 
 
 @router.get("/list")
 async def list_documents():
     """获取文档列表"""
-    return list(_documents.values())
+    return [DocumentInfo(**data) for data in state_service.list_documents()]
 
 
 @router.get("/{doc_id}/chunks")
@@ -133,12 +135,12 @@ async def get_chunk_results(doc_id: str):
 @router.get("/{doc_id}/milvus")
 async def get_milvus_data(doc_id: str):
     """获取文档在向量数据库中的存储数据"""
-    if doc_id not in _documents:
+    doc_info = _get_document(doc_id)
+    if doc_info is None:
         raise HTTPException(status_code=404, detail="文档不存在")
-    provider = _documents[doc_id].model_provider
-    rows = get_doc_chunks(doc_id, model_provider=provider)
-    collection_name = f"{config.MILVUS_COLLECTION}_{provider}"
-    dim = config.EMBEDDING_DIM.get(provider, 1536)
+    provider = doc_info.model_provider
+    rows = get_doc_chunks(doc_id, model_provider=provider, kb=doc_info.kb)
+    collection_name, dim = resolve_collection(provider, doc_info.kb)
     records = []
     for row in rows:
         vec = row.get("vector", [])
@@ -177,85 +179,18 @@ async def get_milvus_data(doc_id: str):
 @router.delete("/{doc_id}")
 async def delete_document(doc_id: str, model_provider: str = "openai"):
     """删除文档"""
-    if doc_id in _documents:
-        provider = _documents[doc_id].model_provider
-        delete_doc_chunks(doc_id, model_provider=provider)
-        # 删除分块结果文件
-        for ext in ("json", "md"):
-            path = os.path.join(CHUNK_RESULTS_DIR, f"{doc_id}.{ext}")
-            if os.path.exists(path):
-                os.remove(path)
-        del _documents[doc_id]
-        return {"message": "删除成功"}
+    doc_info = _get_document(doc_id)
+    if doc_info is not None:
+        provider = doc_info.model_provider
+        # 其他文档中指向本文档的重复块只以本文档的向量存在，先补回，失败时不删除
+        try:
+            restored = await ingest_service.materialize_dependents(doc_id)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"补回其他文档引用的重复块失败，未删除: {e}")
+        delete_doc_chunks(doc_id, model_provider=provider, kb=doc_info.kb)
+        dedup_service.remove_document(doc_id)
+        # 删除分块结果文件和未完成的入库断点
+        ingest_service.remove_document_files(doc_id)
+        state_service.delete_document(doc_id)
+        return {"message": "删除成功", "restored_duplicates": restored}
     raise HTTPException(status_code=404, detail="文档不存在")
-
-
-def _save_chunk_results(
-    doc_id: str,
-    filename: str,
-    chunks: list[str],
-    vectors: list[list[float]],
-    chunk_mode: str,
-    chunk_size: int,
-    overlap: int,
-    model_provider: str,
-):
-    """将分块结果保存为 JSON + Markdown 文件"""
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # --- JSON 文件（结构化数据，含 embedding 前 8 维） ---
-    json_data = {
-        "doc_id": doc_id,
-        "filename": filename,
-        "created_at": now,
-        "config": {
-            "chunk_mode": chunk_mode,
-            "chunk_size": chunk_size,
-            "overlap": overlap,
-            "model_provider": model_provider,
-        },
-        "total_chunks": len(chunks),
-        "chunks": [],
-    }
-    for i, (text, vec) in enumerate(zip(chunks, vectors)):
-        json_data["chunks"].append({
-            "index": i,
-            "token_count": count_tokens(text),
-            "char_count": len(text),
-            "content": text,
-            "embedding_dim": len(vec),
-            "embedding_preview": [round(v, 6) for v in vec[:8]],
-        })
-
-    json_path = os.path.join(CHUNK_RESULTS_DIR, f"{doc_id}.json")
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(json_data, f, ensure_ascii=False, indent=2)
-
-    # --- Markdown 文件（人类可读） ---
-    lines = [
-        f"# 分块结果：{filename}",
-        "",
-        f"- **文档 ID**: `{doc_id}`",
-        f"- **处理时间**: {now}",
-        f"- **分块模式**: {chunk_mode}",
-        f"- **Chunk Size**: {chunk_size}",
-        f"- **Overlap**: {overlap}",
-        f"- **模型**: {model_provider}",
-        f"- **总分块数**: {len(chunks)}",
-        "",
-        "---",
-        "",
-    ]
-    for i, (text, vec) in enumerate(zip(chunks, vectors)):
-        lines.append(f"## Chunk {i} ({count_tokens(text)} tokens, {len(text)} chars)")
-        lines.append("")
-        lines.append(f"**Embedding** ({len(vec)}d): `[{', '.join(f'{v:.4f}' for v in vec[:6])}  ...]`")
-        lines.append("")
-        lines.append("```")
-        lines.append(text)
-        lines.append("```")
-        lines.append("")
-
-    md_path = os.path.join(CHUNK_RESULTS_DIR, f"{doc_id}.md")
-    with open(md_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(lines))
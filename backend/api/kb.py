@@ -0,0 +1,68 @@
+import re
+from datetime import datetime
+from fastapi import APIRouter, HTTPException
+from models.schema import KnowledgeBaseCreate, KnowledgeBaseInfo
+from services import state_service, dedup_service, ingest_service
+from services.milvus_service import get_collection_name, drop_kb_collections
+
+router = APIRouter(prefix="/api/kb", tags=["knowledge_base"])
+
+# Milvus collection 名只允许字母、数字、下划线
+_KB_NAME_RE = re.compile(r"^[A-Za-z0-9_]{1,64}$")
+
+
+def get_kb_or_404(name: str) -> KnowledgeBaseInfo:
+    data = state_service.get_kb(name)
+    if data is None:
+        raise HTTPException(status_code=404, detail=f"知识库不存在: {name}")
+    return KnowledgeBaseInfo(**data)
+
+
+@router.get("")
+async def list_kbs():
+    """获取知识库列表"""
+    return [KnowledgeBaseInfo(**data) for data in state_service.list_kbs()]
+
+
+@router.post("")
+async def create_kb(body: KnowledgeBaseCreate):
+    """创建知识库（独立 collection 与默认分块配置）"""
+    if not _KB_NAME_RE.match(body.name):
+        raise HTTPException(status_code=400, detail="知识库名称仅支持字母、数字、下划线，长度 1-64")
+    if body.model_provider not in ("openai", "bailian"):
+        raise HTTPException(status_code=400, detail="model_provider 仅支持 openai 或 bailian")
+    if body.chunk_mode not in ("sliding", "semantic", "hybrid"):
+        raise HTTPException(status_code=400, detail="chunk_mode 仅支持 sliding/semantic/hybrid")
+    if state_service.get_kb(body.name) is not None:
+        raise HTTPException(status_code=409, detail=f"知识库已存在: {body.name}")
+
+    kb = KnowledgeBaseInfo(
+        **body.model_dump(),
+        collection=get_collection_name(body.model_provider, body.name),
+        created_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    )
+    state_service.save_kb(kb.name, kb.model_dump())
+    return kb
+
+
+@router.get("/{name}")
+async def get_kb(name: str):
+    """获取知识库详情"""
+    kb = get_kb_or_404(name)
+    documents = [doc for doc in state_service.list_documents() if doc.get("kb") == name]
+    return {**kb.model_dump(), "document_count": len(documents)}
+
+
+@router.delete("/{name}")
+async def delete_kb(name: str):
+    """删除知识库及其全部文档和向量数据"""
+    kb = get_kb_or_404(name)
+    drop_kb_collections(kb.model_provider, name)
+    for doc in state_service.list_documents():
+        if doc.get("kb") != name:
+            continue
+        dedup_service.remove_document(doc["doc_id"])
+        ingest_service.remove_document_files(doc["doc_id"])
+        state_service.delete_document(doc["doc_id"])
+    state_service.delete_kb(name)
+    return {"message": "删除成功"}
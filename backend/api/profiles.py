@@ -0,0 +1,24 @@
+import os
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import FileResponse
+from services import profile_service
+
+router = APIRouter(prefix="/api/profiles", tags=["profiles"])
+
+
+@router.get("/{profile_id}")
+async def get_profile(
+    profile_id: str,
+    x_profile: Optional[str] = Header(None),
+    profile: Optional[str] = Query(None),
+):
+    """下载单请求 profile（speedscope 格式，可直接拖入 https://www.speedscope.app 查看）"""
+    if not profile_service.check_token(x_profile or profile):
+        raise HTTPException(status_code=403, detail="需要管理员 token")
+    if not profile_id.isalnum():
+        raise HTTPException(status_code=404, detail="profile 不存在")
+    path = profile_service.profile_path(profile_id)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="profile 不存在")
+    return FileResponse(path, media_type="application/json", filename=os.path.basename(path))
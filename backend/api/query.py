@@ -1,44 +1,97 @@
+import asyncio
 import json
-from fastapi import APIRouter
+import time
+from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
-from models.schema import QueryRequest, QueryResponse, RetrievalHit
-from services.embedding_service import generate_embedding
-from services.milvus_service import search_chunks
+from starlette.background import BackgroundTask
+from models.schema import (
+    QueryRequest,
+    QueryResponse,
+    RetrievalHit,
+    BatchQueryRequest,
+    BatchQueryItem,
+    BatchQueryResponse,
+)
+import config
+from services.embedding_service import generate_embedding, generate_embeddings
+from services.milvus_service import search_chunks, search_chunks_batch, resolve_collection
+from api.kb import get_kb_or_404
 from services.llm_service import generate_answer, stream_answer
+from services.cache_service import llm_cache, question_hash
+from services.singleflight_service import SingleFlight, StreamSingleFlight
+from services.latency_service import Deadline, hedged
+from services.mmr_service import mmr_select
+from services import metrics_service
 
 router = APIRouter(prefix="/api", tags=["query"])
 
+# 相同的并发请求只跑一次检索问答流水线
+_query_flight = SingleFlight()
+_stream_flight = StreamSingleFlight()
+
+
+def _flight_key(req: QueryRequest) -> tuple:
+    """single-flight key：归一化问题 + 影响结果的请求参数"""
+    question = " ".join(req.question.split()).casefold()
+    knowledge_bases = tuple(sorted(set(req.knowledge_bases))) if req.knowledge_bases else None
+    return (
+        question, req.model_provider, req.top_k, req.use_rerank, req.latency_budget_ms, knowledge_bases,
+        req.use_mmr, req.mmr_lambda, req.mmr_fetch_k,
+    )
+
 
 async def rerank_chunks(question: str, chunks: list[dict], model_provider: str = "openai") -> list[dict]:
-    """简单 rerank：使用 LLM 对检索结果进行相关性评分排序"""
+    """简单 rerank：使用 LLM 对检索结果进行相关性评分排序（按 问题 + chunk id 缓存分数，只对新段落打分）"""
     from services.llm_service import call_llm
     import json
 
-    contents = [c["content"] for c in chunks]
-    numbered = "\n".join([f"[{i}] {c}" for i, c in enumerate(contents)])
+    q_hash = question_hash(question, model_provider)
+    cached: dict[str, float] = {}
+    if config.LLM_CACHE_ENABLED:
+        chunk_ids = [str(c["id"]) for c in chunks if c.get("id") is not None]
+        cached = llm_cache.get_scores(q_hash, chunk_ids)
+    for chunk in chunks:
+        if chunk.get("id") is not None and str(chunk["id"]) in cached:
+            chunk["rerank_score"] = cached[str(chunk["id"])]
+    pending = [c for c in chunks if c.get("rerank_score") is None]
 
-    prompt = (
-        "请对以下文本段落与问题的相关性进行打分（0-10分），返回 JSON 格式。\n"
-        "格式: {\"scores\": [分数1, 分数2, ...]}\n"
-        "只返回 JSON，不要其他内容。\n\n"
-        f"问题：{question}\n\n"
-        f"段落：\n{numbered}"
-    )
+    if pending:
+        contents = [c["content"] for c in pending]
+        numbered = "\n".join([f"[{i}] {c}" for i, c in enumerate(contents)])
 
-    try:
-        response = await call_llm(
-            messages=[{"role": "user", "content": prompt}],
-            model_provider=model_provider,
-            temperature=0,
+        prompt = (
+            "请对以下文本段落与问题的相关性进行打分（0-10分），返回 JSON 格式。\n"
+            "格式: {\"scores\": [分数1, 分数2, ...]}\n"
+            "只返回 JSON，不要其他内容。\n\n"
+            f"问题：{question}\n\n"
+            f"段落：\n{numbered}"
         )
-        data = json.loads(response)
-        scores = data.get("scores", [])
-        if len(scores) == len(chunks):
-            for i, chunk in enumerate(chunks):
-                chunk["rerank_score"] = scores[i]
-            chunks.sort(key=lambda x: x.get("rerank_score", 0), reverse=True)
-    except Exception:
-        pass  # rerank 失败时保持原始排序
+
+        try:
+            response = await call_llm(
+                messages=[{"role": "user", "content": prompt}],
+                model_provider=model_provider,
+                temperature=0,
+            )
+            data = json.loads(response)
+            scores = data.get("scores", [])
+            if len(scores) == len(pending):
+                new_scores = {}
+                for chunk, score in zip(pending, scores):
+                    chunk["rerank_score"] = float(score)
+                    if chunk.get("id") is not None:
+                        new_scores[str(chunk["id"])] = float(score)
+                if config.LLM_CACHE_ENABLED:
+                    llm_cache.set_scores(q_hash, new_scores)
+        except Exception:
+            pass  # rerank 失败时保持原始排序
+
+    if all(c.get("rerank_score") is not None for c in chunks):
+        chunks.sort(key=lambda x: x.get("rerank_score", 0), reverse=True)
+    else:
+        # 部分段落缺少分数时不排序，避免混合不可比的结果
+        for chunk in chunks:
+            chunk.pop("rerank_score", None)
 
     return chunks
 
@@ -46,18 +99,27 @@ async def rerank_chunks(question: str, chunks: list[dict], model_provider: str =
 @router.post("/query", response_model=QueryResponse)
 async def query(req: QueryRequest):
     """检索问答"""
-    # 1. 生成 query embedding
-    query_vector = await generate_embedding(req.question, model_provider=req.model_provider)
+    if not config.QUERY_COALESCE:
+        return await _run_query(req)
+    return await _query_flight.do(_flight_key(req), lambda: _run_query(req))
 
-    # 2. Milvus 检索
-    hits = search_chunks(query_vector, model_provider=req.model_provider, top_k=req.top_k)
 
-    if not hits:
-        return QueryResponse(answer="未找到相关文档内容，请先上传文档。", contexts=[])
+async def _run_query(req: QueryRequest) -> QueryResponse:
+    """检索问答流水线"""
+    deadline = Deadline(req.latency_budget_ms or config.QUERY_LATENCY_BUDGET_MS)
+    degraded: list[str] = []
+    kb_latency: dict[str, float] = {}
 
-    # 3. 可选 rerank
-    if req.use_rerank:
-        hits = await rerank_chunks(req.question, hits, model_provider=req.model_provider)
+    # 1-3. 向量检索 + 可选 rerank
+    hits = await _retrieve(req, deadline, degraded, kb_latency)
+
+    if not hits:
+        return QueryResponse(
+            answer="未找到相关文档内容，请先上传文档。",
+            contexts=[],
+            degraded=degraded,
+            kb_latency_ms=kb_latency or None,
+        )
 
     # 4. 构建检索结果（含分数）
     retrieval = []
@@ -66,13 +128,23 @@ async def query(req: QueryRequest):
             content=hit["content"],
             score=float(hit.get("score", 0)),
             rerank_score=float(hit["rerank_score"]) if hit.get("rerank_score") is not None else None,
+            kb=hit.get("kb"),
         ))
 
     # 5. 提取上下文
     contexts = [hit["content"] for hit in hits]
 
-    # 6. 调用 LLM 生成答案
-    answer, prompt = await generate_answer(req.question, contexts, model_provider=req.model_provider)
+    # 6. 调用 LLM 生成答案（对冲慢请求）；超出剩余预算时只返回检索结果
+    try:
+        if deadline.expired():
+            raise asyncio.TimeoutError
+        answer, prompt = await asyncio.wait_for(
+            generate_answer(req.question, contexts, model_provider=req.model_provider, hedge=True),
+            timeout=deadline.remaining(),
+        )
+    except asyncio.TimeoutError:
+        degraded.append("answer")
+        answer, prompt = "生成回答超出延迟预算，请参考检索结果。", None
 
     return QueryResponse(
         answer=answer,
@@ -80,66 +152,344 @@ async def query(req: QueryRequest):
         retrieval=retrieval,
         use_rerank=req.use_rerank,
         prompt=prompt,
+        degraded=degraded,
+        kb_latency_ms=kb_latency or None,
     )
 
 
-@router.post("/query/stream")
-async def query_stream(req: QueryRequest):
-    """流式检索问答 (SSE)"""
+async def _embed_query(question: str, model_provider: str, dim: int, deadline: Deadline) -> list[float]:
+    """生成 query embedding（按历史延迟分位数对冲，维度与目标 collection 一致）"""
+    try:
+        return await asyncio.wait_for(
+            hedged(
+                f"embedding:{model_provider}",
+                lambda: generate_embedding(question, model_provider=model_provider, dimensions=dim),
+            ),
+            timeout=deadline.remaining(),
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="query embedding 超出延迟预算")
+
+
+async def _search_within(deadline: Deadline, *args) -> list[dict]:
+    """在剩余预算内执行 Milvus 检索（同步调用放到线程中，不阻塞事件循环）"""
+    try:
+        return await asyncio.wait_for(asyncio.to_thread(search_chunks, *args), timeout=deadline.remaining())
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="向量检索超出延迟预算")
 
-    async def event_generator():
+
+def _mmr_params(req: QueryRequest) -> tuple[int, float] | None:
+    """返回 MMR 的 (候选数, λ)；未启用时为 None"""
+    if not req.use_mmr:
+        return None
+    lambda_mult = config.MMR_LAMBDA if req.mmr_lambda is None else req.mmr_lambda
+    if not 0 <= lambda_mult <= 1:
+        raise HTTPException(status_code=400, detail="mmr_lambda 应在 0-1 之间")
+    fetch_k = req.mmr_fetch_k or req.top_k * config.MMR_FETCH_FACTOR
+    return max(req.top_k, min(fetch_k, config.MMR_MAX_FETCH_K)), lambda_mult
+
+
+def _apply_mmr(query_vector: list[float], hits: list[dict], top_k: int, lambda_mult: float) -> list[dict]:
+    """从带向量的候选中用 MMR 选出 top_k，并去掉候选向量"""
+    selected = mmr_select(query_vector, [hit["vector"] for hit in hits], top_k, lambda_mult)
+    for hit in hits:
+        hit.pop("vector", None)
+    return [hits[i] for i in selected]
+
+
+async def _search_kbs(
+    req: QueryRequest, deadline: Deadline, kb_latency: dict[str, float], mmr: tuple[int, float] | None = None
+) -> list[dict]:
+    """多知识库并行检索：同一 embedding 空间只生成一次 query 向量，各空间内分数 min-max 归一化后合并为一个 top-k；
+    启用 MMR 时在各空间内先做多样性选择"""
+    kbs = [get_kb_or_404(name) for name in dict.fromkeys(req.knowledge_bases)]
+    # (provider, 维度) -> 知识库名；不同空间的余弦分数不可直接比较
+    groups: dict[tuple[str, int], list[str]] = {}
+    for kb in kbs:
+        _, dim = resolve_collection(kb.model_provider, kb.name)
+        groups.setdefault((kb.model_provider, dim), []).append(kb.name)
+    vectors = await asyncio.gather(*(
+        _embed_query(req.question, provider, dim, deadline) for provider, dim in groups
+    ))
+
+    async def _search_one(provider: str, kb: str, vector: list[float]) -> list[dict]:
+        start = time.monotonic()
+        top_k = mmr[0] if mmr else req.top_k
+        hits = await _search_within(deadline, vector, provider, top_k, kb, mmr is not None)
+        kb_latency[kb] = round((time.monotonic() - start) * 1000, 1)
+        for hit in hits:
+            hit["kb"] = kb
+        return hits
+
+    group_hits = await asyncio.gather(*(
+        asyncio.gather(*(_search_one(provider, kb, vector) for kb in names))
+        for ((provider, _), names), vector in zip(groups.items(), vectors)
+    ))
+
+    merged: list[tuple[float, dict]] = []
+    for results, vector in zip(group_hits, vectors):
+        hits = [hit for kb_hits in results for hit in kb_hits]
+        if not hits:
+            continue
+        if mmr:
+            hits = _apply_mmr(vector, hits, req.top_k, mmr[1])
+        low = min(hit["score"] for hit in hits)
+        span = max(hit["score"] for hit in hits) - low
+        for hit in hits:
+            merged.append(((hit["score"] - low) / span if span > 0 else 1.0, hit))
+    merged.sort(key=lambda item: item[0], reverse=True)
+    return [hit for _, hit in merged[:req.top_k]]
+
+
+async def _retrieve(
+    req: QueryRequest, deadline: Deadline, degraded: list[str], kb_latency: dict[str, float] | None = None
+) -> list[dict]:
+    """在延迟预算内完成 query embedding、Milvus 检索、可选 MMR 和 rerank；rerank 超出预算时回退到向量排序"""
+    mmr = _mmr_params(req)
+    if req.knowledge_bases:
+        # 1-2. 指定知识库：各库并行检索后合并
+        hits = await _search_kbs(req, deadline, kb_latency if kb_latency is not None else {}, mmr)
+    else:
         # 1. 生成 query embedding
-        query_vector = await generate_embedding(req.question, model_provider=req.model_provider)
+        _, dim = resolve_collection(req.model_provider)
+        query_vector = await _embed_query(req.question, req.model_provider, dim, deadline)
+
+        # 2. Milvus 检索；启用 MMR 时多取候选（含向量），再选出兼顾相关性与多样性的 top_k
+        if mmr:
+            candidates = await _search_within(deadline, query_vector, req.model_provider, mmr[0], None, True)
+            hits = _apply_mmr(query_vector, candidates, req.top_k, mmr[1])
+        else:
+            hits = await _search_within(deadline, query_vector, req.model_provider, req.top_k)
+
+    # 3. 可选 rerank：只使用扣除答案生成预留后的剩余预算
+    if hits and req.use_rerank:
+        rerank_budget = deadline.remaining() - config.QUERY_ANSWER_RESERVE_MS / 1000
+        if rerank_budget <= 0:
+            degraded.append("rerank")
+        else:
+            try:
+                # rerank 会原地修改命中结果，传入副本以便超时后保留原始向量排序
+                hits = await asyncio.wait_for(
+                    rerank_chunks(req.question, [dict(hit) for hit in hits], model_provider=req.model_provider),
+                    timeout=rerank_budget,
+                )
+            except asyncio.TimeoutError:
+                degraded.append("rerank")
 
-        # 2. Milvus 检索
-        hits = search_chunks(query_vector, model_provider=req.model_provider, top_k=req.top_k)
+    return hits
 
+
+@router.post("/query/batch", response_model=BatchQueryResponse)
+async def query_batch(req: BatchQueryRequest):
+    """批量检索问答：一次批量 embedding + 一次多向量检索，LLM 回答按并发上限执行"""
+    if len(req.questions) > config.BATCH_QUERY_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"questions 数量不能超过 {config.BATCH_QUERY_MAX_QUESTIONS}",
+        )
+    if not req.questions:
+        return BatchQueryResponse(results=[])
+
+    # 空问题在 embedding 前剔除，只让对应条目失败，不影响整批 embedding
+    valid = [i for i, question in enumerate(req.questions) if question.strip()]
+
+    # 1. 批量生成 query embedding
+    _, dim = resolve_collection(req.model_provider)
+    query_vectors = []
+    if valid:
+        query_vectors = await generate_embeddings(
+            [req.questions[i] for i in valid], model_provider=req.model_provider, dimensions=dim
+        )
+
+    # 2. Milvus 多向量检索（nq > 1，同步调用放到线程中，避免阻塞事件循环）
+    valid_hits = []
+    if valid:
+        valid_hits = await asyncio.to_thread(
+            search_chunks_batch, query_vectors, model_provider=req.model_provider, top_k=req.top_k
+        )
+    all_hits: list[list[dict] | None] = [None] * len(req.questions)
+    for i, hits in zip(valid, valid_hits):
+        all_hits[i] = hits
+
+    semaphore = asyncio.Semaphore(max(1, req.concurrency or config.BATCH_QUERY_CONCURRENCY))
+
+    async def _answer_one(question: str, hits: list[dict] | None) -> BatchQueryItem:
+        if hits is None:
+            return BatchQueryItem(question=question, answer="", contexts=[], error="问题不能为空")
         if not hits:
-            yield f"event: metadata\ndata: {json.dumps({'retrieval': [], 'contexts': [], 'use_rerank': False, 'prompt': ''})}\n\n"
-            yield f"event: delta\ndata: {json.dumps({'content': '未找到相关文档内容，请先上传文档。'})}\n\n"
-            yield "event: done\ndata: {}\n\n"
-            return
+            return BatchQueryItem(question=question, answer="未找到相关文档内容，请先上传文档。", contexts=[])
+        try:
+            async with semaphore:
+                # 3. 可选 rerank
+                if req.use_rerank:
+                    hits = await rerank_chunks(question, hits, model_provider=req.model_provider)
 
-        # 3. 可选 rerank
-        if req.use_rerank:
-            hits = await rerank_chunks(req.question, hits, model_provider=req.model_provider)
+                retrieval = [
+                    RetrievalHit(
+                        content=hit["content"],
+                        score=float(hit.get("score", 0)),
+                        rerank_score=float(hit["rerank_score"]) if hit.get("rerank_score") is not None else None,
+                    )
+                    for hit in hits
+                ]
+                contexts = [hit["content"] for hit in hits]
 
-        # 4. 构建检索结果
-        retrieval = []
-        for hit in hits:
-            retrieval.append({
-                "content": hit["content"],
-                "score": float(hit.get("score", 0)),
-                "rerank_score": float(hit["rerank_score"]) if hit.get("rerank_score") is not None else None,
-            })
-
-        # 5. 提取上下文
-        contexts = [hit["content"] for hit in hits]
-
-        # 6. 流式生成
-        gen, prompt = await stream_answer(req.question, contexts, model_provider=req.model_provider)
-
-        # 发送 metadata
-        metadata = {
-            "retrieval": retrieval,
-            "contexts": contexts,
-            "use_rerank": req.use_rerank,
-            "prompt": prompt,
-        }
-        yield f"event: metadata\ndata: {json.dumps(metadata, ensure_ascii=False)}\n\n"
-
-        # 发送 delta
-        async for chunk_text in gen:
-            yield f"event: delta\ndata: {json.dumps({'content': chunk_text}, ensure_ascii=False)}\n\n"
-
-        # 发送 done
-        yield "event: done\ndata: {}\n\n"
+                if req.retrieval_only:
+                    return BatchQueryItem(
+                        question=question,
+                        answer="",
+                        contexts=contexts,
+                        retrieval=retrieval,
+                        use_rerank=req.use_rerank,
+                    )
+
+                # 4. 调用 LLM 生成答案
+                answer, prompt = await generate_answer(question, contexts, model_provider=req.model_provider)
+        except Exception as e:
+            # 单条失败不影响整批结果
+            return BatchQueryItem(question=question, answer="", contexts=[], error=str(e))
+
+        return BatchQueryItem(
+            question=question,
+            answer=answer,
+            contexts=contexts,
+            retrieval=retrieval,
+            use_rerank=req.use_rerank,
+            prompt=prompt,
+        )
+
+    results = await asyncio.gather(
+        *(_answer_one(question, hits) for question, hits in zip(req.questions, all_hits))
+    )
+    return BatchQueryResponse(results=list(results))
 
+
+@router.post("/query/stream")
+async def query_stream(req: QueryRequest):
+    """流式检索问答 (SSE)"""
+
+    if config.QUERY_COALESCE:
+        events = _stream_flight.subscribe(_flight_key(req), lambda: _query_events(req))
+    else:
+        events = _query_events(req)
+
+    # 客户端在流开始迭代前断开时 _track_stream 不会执行，由 background 兜底关闭订阅
     return StreamingResponse(
-        event_generator(),
+        _track_stream(events),
         media_type="text/event-stream",
+        background=BackgroundTask(events.aclose),
         headers={
             "Cache-Control": "no-cache",
             "X-Accel-Buffering": "no",
         },
     )
+
+
+async def _track_stream(events):
+    """统计 SSE 流的完成 / 客户端断开；断开时关闭订阅，最后一个订阅者离开会取消上游"""
+    metrics_service.incr("sse_streams_started")
+    completed = False
+    try:
+        async for event in events:
+            yield event
+        completed = True
+    finally:
+        metrics_service.incr("sse_streams_completed" if completed else "sse_streams_cancelled")
+        await events.aclose()
+
+
+def _delta_event(content: str) -> str:
+    return f"event: delta\ndata: {json.dumps({'content': content}, ensure_ascii=False)}\n\n"
+
+
+async def _query_events(req: QueryRequest):
+    """流式检索问答流水线，逐条产出 SSE 事件；被取消时（客户端全部断开）中止 rerank / 上游流式生成"""
+    try:
+        async for event in _query_events_inner(req):
+            yield event
+    except (asyncio.CancelledError, GeneratorExit):
+        metrics_service.incr("sse_upstream_cancelled")
+        raise
+
+
+async def _query_events_inner(req: QueryRequest):
+    deadline = Deadline(req.latency_budget_ms or config.QUERY_LATENCY_BUDGET_MS)
+    degraded: list[str] = []
+    kb_latency: dict[str, float] = {}
+
+    # 1-3. 向量检索 + 可选 rerank
+    hits = await _retrieve(req, deadline, degraded, kb_latency)
+
+    if not hits:
+        empty = {"retrieval": [], "contexts": [], "use_rerank": False, "prompt": "", "degraded": degraded, "kb_latency_ms": kb_latency or None}
+        yield f"event: metadata\ndata: {json.dumps(empty, ensure_ascii=False)}\n\n"
+        yield _delta_event("未找到相关文档内容，请先上传文档。")
+        yield "event: done\ndata: {}\n\n"
+        return
+
+    # 4. 构建检索结果
+    retrieval = []
+    for hit in hits:
+        retrieval.append({
+            "content": hit["content"],
+            "score": float(hit.get("score", 0)),
+            "rerank_score": float(hit["rerank_score"]) if hit.get("rerank_score") is not None else None,
+            "kb": hit.get("kb"),
+        })
+
+    # 5. 提取上下文
+    contexts = [hit["content"] for hit in hits]
+
+    # 6. 流式生成
+    gen, prompt = await stream_answer(req.question, contexts, model_provider=req.model_provider, hedge=True)
+
+    # 发送 metadata
+    metadata = {
+        "retrieval": retrieval,
+        "contexts": contexts,
+        "use_rerank": req.use_rerank,
+        "prompt": prompt,
+        "degraded": degraded,
+        "kb_latency_ms": kb_latency or None,
+    }
+    yield f"event: metadata\ndata: {json.dumps(metadata, ensure_ascii=False)}\n\n"
+
+    # 发送 delta：合并多个 token 为一帧，减少逐 token 的序列化和分帧开销（首 token 立即发送）。
+    # 等待下一个 token 时以剩余间隔为超时，上游停顿时缓冲内容也按间隔发出
+    buffer: list[str] = []
+    buffered_bytes = 0
+    last_flush = 0.0
+    interval = config.SSE_FLUSH_INTERVAL_MS / 1000
+    next_chunk: asyncio.Future | None = None
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(gen.__anext__())
+            timeout = max(0.0, last_flush + interval - time.monotonic()) if buffer else None
+            done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+            if done:
+                finished, next_chunk = next_chunk, None
+                try:
+                    chunk_text = finished.result()
+                except StopAsyncIteration:
+                    break
+                buffer.append(chunk_text)
+                buffered_bytes += len(chunk_text.encode("utf-8"))
+            now = time.monotonic()
+            if buffer and (buffered_bytes >= config.SSE_FLUSH_BYTES or now - last_flush >= interval):
+                yield _delta_event("".join(buffer))
+                buffer.clear()
+                buffered_bytes = 0
+                last_flush = now
+    finally:
+        # 提前退出时立即关闭上游流式连接（先结束挂起的 __anext__，否则无法 aclose）
+        if next_chunk is not None:
+            next_chunk.cancel()
+            await asyncio.gather(next_chunk, return_exceptions=True)
+        await gen.aclose()
+    if buffer:
+        yield _delta_event("".join(buffer))
+
+    # 发送 done
+    yield "event: done\ndata: {}\n\n"
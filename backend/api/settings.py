@@ -22,8 +22,11 @@ def _read_settings() -> dict:
 
 
 def _write_settings(data: dict):
-    with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
+    # 先写临时文件再原子替换，避免其他 worker 读到半写入的文件
+    tmp_path = f"{SETTINGS_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, SETTINGS_FILE)
 
 
 def _mask(value: str) -> str:
@@ -58,8 +61,10 @@ async def save_settings(body: dict):
 
     _write_settings(current)
 
-    # 热更新 config 模块中的值
+    # 热更新 config 模块中的值，并通知其他 worker 重新加载
     import config
+    from services import state_service
     config.reload_from_settings()
+    state_service.notify("settings")
 
     return {"message": "配置已保存"}
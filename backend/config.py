@@ -50,6 +50,28 @@ def reload_from_settings():
     OPENAI_BASE_URL = _settings.get("openai_base_url") or os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
     BAILIAN_API_KEY = _settings.get("bailian_api_key") or os.getenv("BAILIAN_API_KEY", "")
 
+
+# --- 出站限流（embedding / LLM 共享，按 provider） ---
+# 以下为整个部署的 provider 配额；令牌桶在每个 worker 进程内，按 WEB_CONCURRENCY（worker 数）均分
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+RATE_LIMITS = {
+    "openai": {
+        "rpm": int(os.getenv("OPENAI_RPM", "3000")),
+        "tpm": int(os.getenv("OPENAI_TPM", "1000000")),
+        "max_concurrency": int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")),
+    },
+    "bailian": {
+        "rpm": int(os.getenv("BAILIAN_RPM", "1200")),
+        "tpm": int(os.getenv("BAILIAN_TPM", "1000000")),
+        "max_concurrency": int(os.getenv("BAILIAN_MAX_CONCURRENCY", "8")),
+    },
+}
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "6"))
+RATE_LIMIT_BACKOFF_BASE = 0.5  # 秒
+RATE_LIMIT_BACKOFF_MAX = 30.0  # 秒
+RATE_LIMIT_LATENCY_FACTOR = 3.0  # 单次耗时超过 EWMA 的倍数时降低并发
+LLM_COMPLETION_TOKEN_ESTIMATE = 500  # 计入 TPM 的预估输出 token 数
+
 # --- Milvus ---
 MILVUS_HOST = os.getenv("MILVUS_HOST", "localhost")
 MILVUS_PORT = int(os.getenv("MILVUS_PORT", "19530"))
@@ -61,16 +83,109 @@ EMBEDDING_DIM = {
     "bailian": 768,
 }
 
+# --- 降维 embedding（新建 collection 使用的维度，留空为模型原生维度） ---
+# text-embedding-3 系列原生支持 dimensions 参数；其他模型在客户端截断并归一化
+EMBEDDING_DIMENSIONS = {
+    "openai": int(os.getenv("OPENAI_EMBEDDING_DIMENSIONS", "0")) or None,
+    "bailian": int(os.getenv("BAILIAN_EMBEDDING_DIMENSIONS", "0")) or None,
+}
+
+# --- Embedding 批量上限（单次请求最多文本条数） ---
+EMBEDDING_BATCH_SIZE = {
+    "openai": 2048,
+    "bailian": 25,
+}
+
 # --- Milvus Index ---
 HNSW_M = 16
 HNSW_EF_CONSTRUCTION = 200
 HNSW_EF = 64
 SEARCH_TOP_K = 5
 
+# --- Query ---
+# 相同问题的并发请求合并为一次流水线执行（single-flight）
+QUERY_COALESCE = os.getenv("QUERY_COALESCE", "true").lower() == "true"
+
+# 单次检索问答的默认延迟预算（毫秒），可由 QueryRequest.latency_budget_ms 覆盖
+QUERY_LATENCY_BUDGET_MS = int(os.getenv("QUERY_LATENCY_BUDGET_MS", "20000"))
+# 为最终 LLM 生成预留的时间（毫秒），rerank 只能使用剩余部分
+QUERY_ANSWER_RESERVE_MS = int(os.getenv("QUERY_ANSWER_RESERVE_MS", "8000"))
+
+# --- Hedged Requests（embedding / 首 token 对冲） ---
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_SAMPLE_WINDOW = 200
+HEDGE_MIN_DELAY_MS = 50
+
+# --- SSE ---
+# delta 合并发送：累计达到字节数或距上次发送超过间隔时发送一帧（均为 0 时逐 token 发送）
+SSE_FLUSH_INTERVAL_MS = int(os.getenv("SSE_FLUSH_INTERVAL_MS", "50"))
+SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", "256"))
+
+# --- MMR 多样性重排 ---
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.5"))  # 1 为纯相关性，越小越偏向多样性
+MMR_FETCH_FACTOR = int(os.getenv("MMR_FETCH_FACTOR", "4"))  # 候选数 = top_k * 该倍数
+MMR_MAX_FETCH_K = int(os.getenv("MMR_MAX_FETCH_K", "200"))
+
+# --- Batch Query ---
+BATCH_QUERY_MAX_QUESTIONS = int(os.getenv("BATCH_QUERY_MAX_QUESTIONS", "1000"))
+BATCH_QUERY_CONCURRENCY = int(os.getenv("BATCH_QUERY_CONCURRENCY", "8"))
+
+# --- LLM Cache（确定性调用：rerank / 语义分块） ---
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(os.path.dirname(__file__), "cache", "llm_cache.db"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # 秒
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000"))
+
 # --- Chunk ---
 DEFAULT_CHUNK_SIZE = 500
 DEFAULT_OVERLAP = 100
+# hybrid 模式下小于 chunk_size * 该比例的语义块视为碎片，与相邻块合并
+HYBRID_MIN_CHUNK_RATIO = float(os.getenv("HYBRID_MIN_CHUNK_RATIO", "0.2"))
+
+# --- 共享状态（多 worker / 多副本） ---
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", os.path.join(os.path.dirname(__file__), "state", "state.db"))
+STATE_SYNC_INTERVAL = float(os.getenv("STATE_SYNC_INTERVAL", "1.0"))  # 秒
+
+# --- 启动预热 ---
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_PROVIDERS = [p.strip() for p in os.getenv("WARMUP_PROVIDERS", "openai,bailian").split(",") if p.strip()]
+WARMUP_PROVIDER_TIMEOUT = 10.0  # 秒
+WARMUP_RETRY_INTERVAL = 5.0  # 秒
+
+# --- 近重复 chunk 检测（MinHash + LSH） ---
+# "off" 关闭；"skip" 丢弃近重复块；"link" 丢弃并在分块结果中记录其指向的已有块
+DEDUP_MODE = os.getenv("DEDUP_MODE", "skip")
+DEDUP_DB_PATH = os.getenv("DEDUP_DB_PATH", os.path.join(os.path.dirname(__file__), "state", "dedup.db"))
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.85"))  # 估算 Jaccard 相似度阈值
+DEDUP_NUM_PERM = 128
+DEDUP_BANDS = 16  # 16 bands x 8 rows，候选阈值约 0.7
+DEDUP_SHINGLE_SIZE = 5  # 字符 n-gram
 
 # --- Upload ---
 UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+# --- 分块结果（JSON / Markdown / 完整向量 .npy） ---
+CHUNK_RESULTS_DIR = os.path.join(os.path.dirname(__file__), "chunk_results")
+
+# --- 本地 chunk 存储 ---
+# 启用后 chunk 文本保存在本地追加写入的 mmap 文件中，Milvus 只保存 doc_id、向量和引用，
+# 降低 Milvus 内存占用和每次检索的返回数据量；仅对启用后新写入的数据生效
+CHUNK_STORE_ENABLED = os.getenv("CHUNK_STORE_ENABLED", "false").lower() == "true"
+CHUNK_STORE_DIR = os.getenv("CHUNK_STORE_DIR", os.path.join(os.path.dirname(__file__), "chunk_store"))
+
+# --- 单请求 profiling ---
+# 为空时关闭；请求带 X-Profile: <token> 头或 ?profile=<token> 时 profile 该请求
+PROFILE_ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(__file__), "profiles"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.001"))  # pyinstrument 采样间隔（秒）
+
+# --- 断点续传入库 ---
+INGEST_CHECKPOINT_DIR = os.getenv("INGEST_CHECKPOINT_DIR", os.path.join(os.path.dirname(__file__), "ingest"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))  # 每批 embedding / 写入的 chunk 数（断点粒度）
+INGEST_RESUME_ON_STARTUP = os.getenv("INGEST_RESUME_ON_STARTUP", "true").lower() == "true"
+
+# --- 快照导入 ---
+SNAPSHOT_INSERT_BATCH = int(os.getenv("SNAPSHOT_INSERT_BATCH", "10000"))
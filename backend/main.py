@@ -1,5 +1,7 @@
+import asyncio
 import os
 import traceback
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
@@ -7,8 +9,46 @@ from fastapi.middleware.cors import CORSMiddleware
 from api.document import router as document_router
 from api.query import router as query_router
 from api.settings import router as settings_router
+from api.kb import router as kb_router
+from api.profiles import router as profiles_router
+from services.rate_limit_service import ProviderRateLimitError
+from services import state_service, warmup_service, metrics_service, ingest_service
+from services.profile_service import ProfileMiddleware
+import config
 
-app = FastAPI(title="RAG Knowledge Base", version="1.0.0")
+
+async def _state_sync_loop():
+    """定期检查其他 worker 对共享状态的修改（settings 热更新、collection 加载状态）"""
+    while True:
+        try:
+            state_service.sync()
+        except Exception:
+            traceback.print_exc()
+        await asyncio.sleep(config.STATE_SYNC_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    state_service.on_change("settings", config.reload_from_settings)
+    state_service.sync()
+    sync_task = asyncio.create_task(_state_sync_loop())
+    # 预热在后台执行，完成前 /api/ready 返回 503
+    if config.WARMUP_ENABLED:
+        warmup_task = asyncio.create_task(warmup_service.run_warmup())
+    else:
+        warmup_task = None
+        warmup_service.mark_ready()
+    # 继续上次进程退出时未完成的文档入库
+    resume_task = asyncio.create_task(ingest_service.resume_pending()) if config.INGEST_RESUME_ON_STARTUP else None
+    yield
+    sync_task.cancel()
+    if warmup_task is not None:
+        warmup_task.cancel()
+    if resume_task is not None:
+        resume_task.cancel()
+
+
+app = FastAPI(title="RAG Knowledge Base", version="1.0.0", lifespan=lifespan)
 
 
 @app.exception_handler(Exception)
@@ -16,6 +56,12 @@ async def global_exception_handler(request: Request, exc: Exception):
     tb = traceback.format_exception(type(exc), exc, exc.__traceback__)
     return JSONResponse(status_code=500, content={"detail": str(exc), "traceback": "".join(tb)})
 
+
+@app.exception_handler(ProviderRateLimitError)
+async def rate_limit_exception_handler(request: Request, exc: ProviderRateLimitError):
+    headers = {"Retry-After": str(int(exc.retry_after))} if exc.retry_after else None
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers=headers)
+
 # CORS 配置，允许前端访问
 app.add_middleware(
     CORSMiddleware,
@@ -23,11 +69,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Profile-Id"],
 )
 
+# 单请求 profiling（需配置 ADMIN_TOKEN，未带 token 的请求直接透传）
+app.add_middleware(ProfileMiddleware)
+
 app.include_router(document_router)
 app.include_router(query_router)
 app.include_router(settings_router)
+app.include_router(kb_router)
+app.include_router(profiles_router)
 
 
 @app.get("/api/health")
@@ -35,6 +87,21 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/api/metrics")
+async def metrics():
+    """进程内运行指标（如 SSE 流完成 / 取消次数）"""
+    return metrics_service.snapshot()
+
+
+@app.get("/api/ready")
+async def ready():
+    """就绪检查：启动预热完成后才返回 200"""
+    state = warmup_service.get_state()
+    if not state["ready"]:
+        return JSONResponse(status_code=503, content={"status": "warming_up", **state})
+    return {"status": "ready", **state}
+
+
 # ---------- 静态文件托管（Docker 打包模式） ----------
 _static_dir = os.path.join(os.path.dirname(__file__), "static")
 if os.path.isdir(_static_dir):
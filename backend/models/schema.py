@@ -7,6 +7,7 @@ class UploadRequest(BaseModel):
     chunk_size: int = 500
     overlap: int = 100
     model_provider: str = "openai"  # "openai" | "bailian"
+    kb: Optional[str] = None  # 目标知识库，为空时写入默认知识库
 
 
 class QueryRequest(BaseModel):
@@ -14,12 +15,18 @@ class QueryRequest(BaseModel):
     model_provider: str = "openai"
     top_k: int = 5
     use_rerank: bool = True
+    latency_budget_ms: Optional[int] = None  # 默认取 config.QUERY_LATENCY_BUDGET_MS
+    knowledge_bases: Optional[list[str]] = None  # 为空时检索默认知识库；多个时并发检索后合并排序
+    use_mmr: bool = False  # 多取候选后用 MMR 选出兼顾相关性与多样性的 top_k
+    mmr_lambda: Optional[float] = None  # 0-1，默认取 config.MMR_LAMBDA
+    mmr_fetch_k: Optional[int] = None  # 候选数，默认 top_k * config.MMR_FETCH_FACTOR
 
 
 class RetrievalHit(BaseModel):
     content: str
     score: float
     rerank_score: Optional[float] = None
+    kb: Optional[str] = None
 
 
 class QueryResponse(BaseModel):
@@ -28,6 +35,26 @@ class QueryResponse(BaseModel):
     retrieval: Optional[list[RetrievalHit]] = None
     use_rerank: bool = False
     prompt: Optional[str] = None
+    degraded: list[str] = []  # 因超出延迟预算被跳过/截断的阶段，如 ["rerank"]
+    kb_latency_ms: Optional[dict[str, float]] = None  # 多知识库检索时各知识库的检索耗时
+
+
+class BatchQueryRequest(BaseModel):
+    questions: list[str]
+    model_provider: str = "openai"
+    top_k: int = 5
+    use_rerank: bool = False
+    retrieval_only: bool = False  # 只返回检索结果，不调用 LLM 生成答案
+    concurrency: Optional[int] = None  # LLM 并发上限，默认取 config.BATCH_QUERY_CONCURRENCY
+
+
+class BatchQueryItem(QueryResponse):
+    question: str
+    error: Optional[str] = None
+
+
+class BatchQueryResponse(BaseModel):
+    results: list[BatchQueryItem]
 
 
 class DocumentInfo(BaseModel):
@@ -39,3 +66,19 @@ class DocumentInfo(BaseModel):
     chunk_mode: str = "sliding"
     chunk_size: int = 500
     overlap: int = 100
+    duplicate_count: int = 0  # 上传时被判定为近重复而跳过的块数
+    kb: Optional[str] = None  # 所属知识库，为空时属于默认知识库
+
+
+class KnowledgeBaseCreate(BaseModel):
+    name: str  # 仅字母、数字、下划线
+    description: str = ""
+    model_provider: str = "openai"
+    chunk_mode: str = "sliding"
+    chunk_size: int = 500
+    overlap: int = 100
+
+
+class KnowledgeBaseInfo(KnowledgeBaseCreate):
+    collection: str
+    created_at: str
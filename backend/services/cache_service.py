@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import config
+
+# 每写入多少次执行一次过期/容量淘汰
+_EVICT_EVERY = 100
+
+
+class LLMCache:
+    """确定性 LLM 调用的持久化缓存（SQLite），支持 TTL 与按容量淘汰（最久未访问优先）"""
+
+    def __init__(self, path: str, ttl: int, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rerank_scores ("
+                "question_hash TEXT NOT NULL, chunk_id TEXT NOT NULL, score REAL NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+                "PRIMARY KEY (question_hash, chunk_id))"
+            )
+            self._conn = conn
+        return self._conn
+
+    # --- LLM 响应 ---
+
+    def get_response(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value FROM llm_responses WHERE key = ? AND created_at > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE llm_responses SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return row[0]
+
+    def set_response(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            conn.commit()
+            self._maybe_evict(conn, now)
+
+    # --- Rerank 分数 ---
+
+    def get_scores(self, question_hash: str, chunk_ids: list[str]) -> dict[str, float]:
+        if not chunk_ids:
+            return {}
+        now = time.time()
+        placeholders = ",".join("?" * len(chunk_ids))
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                f"SELECT chunk_id, score FROM rerank_scores "
+                f"WHERE question_hash = ? AND created_at > ? AND chunk_id IN ({placeholders})",
+                (question_hash, now - self.ttl, *chunk_ids),
+            ).fetchall()
+            if rows:
+                conn.execute(
+                    f"UPDATE rerank_scores SET accessed_at = ? "
+                    f"WHERE question_hash = ? AND chunk_id IN ({placeholders})",
+                    (now, question_hash, *[r[0] for r in rows]),
+                )
+                conn.commit()
+            return {chunk_id: score for chunk_id, score in rows}
+
+    def set_scores(self, question_hash: str, scores: dict[str, float]):
+        if not scores:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO rerank_scores "
+                "(question_hash, chunk_id, score, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                [(question_hash, chunk_id, score, now, now) for chunk_id, score in scores.items()],
+            )
+            conn.commit()
+            self._maybe_evict(conn, now)
+
+    # --- 淘汰 ---
+
+    def _maybe_evict(self, conn: sqlite3.Connection, now: float):
+        self._writes += 1
+        if self._writes % _EVICT_EVERY:
+            return
+        for table in ("llm_responses", "rerank_scores"):
+            conn.execute(f"DELETE FROM {table} WHERE created_at <= ?", (now - self.ttl,))
+            count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    f"DELETE FROM {table} WHERE rowid IN "
+                    f"(SELECT rowid FROM {table} ORDER BY accessed_at ASC LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+        conn.commit()
+
+
+llm_cache = LLMCache(config.LLM_CACHE_PATH, config.LLM_CACHE_TTL, config.LLM_CACHE_MAX_ENTRIES)
+
+
+def make_llm_key(model: str, messages: list[dict], temperature: float) -> str:
+    """按模型 + 完整 prompt 生成缓存 key"""
+    payload = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def question_hash(question: str, model_provider: str) -> str:
+    """rerank 分数缓存的问题 key（区分 provider，分数来自不同模型）"""
+    return hashlib.sha256(f"{model_provider}\n{question}".encode("utf-8")).hexdigest()
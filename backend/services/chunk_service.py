@@ -1,16 +1,24 @@
-import tiktoken
+from functools import lru_cache
+import config
 from services.llm_service import call_llm
 
 
+@lru_cache(maxsize=1)
+def get_encoding():
+    """延迟加载 tiktoken 编码器（首次调用时加载 BPE 词表）"""
+    import tiktoken
+
+    return tiktoken.get_encoding("cl100k_base")
+
+
 def count_tokens(text: str) -> int:
     """使用 tiktoken 计算 token 数"""
-    enc = tiktoken.get_encoding("cl100k_base")
-    return len(enc.encode(text))
+    return len(get_encoding().encode(text))
 
 
 def sliding_window_chunk(text: str, chunk_size: int = 500, overlap: int = 100) -> list[str]:
     """滑动窗口 + overlap 分块"""
-    enc = tiktoken.get_encoding("cl100k_base")
+    enc = get_encoding()
     tokens = enc.encode(text)
 
     chunks = []
@@ -41,6 +49,8 @@ async def semantic_chunk(text: str, model_provider: str = "openai") -> list[str]
     response = await call_llm(
         messages=[{"role": "user", "content": prompt}],
         model_provider=model_provider,
+        temperature=0,
+        use_cache=True,
     )
 
     import json
@@ -60,6 +70,29 @@ async def semantic_chunk(text: str, model_provider: str = "openai") -> list[str]
     return [c.strip() for c in chunks if c.strip()]
 
 
+def bound_chunks(chunks: list[str], chunk_size: int = 500, overlap: int = 100) -> list[str]:
+    """限制分块长度：超过 chunk_size token 的块用滑动窗口再切分，过小的碎片与相邻块合并（合并后不超过 chunk_size）"""
+    min_tokens = max(1, int(chunk_size * config.HYBRID_MIN_CHUNK_RATIO))
+    pieces: list[tuple[str, int]] = []
+    for chunk in chunks:
+        tokens = count_tokens(chunk)
+        if tokens > chunk_size:
+            pieces.extend((sub, count_tokens(sub)) for sub in sliding_window_chunk(chunk, chunk_size, overlap))
+        else:
+            pieces.append((chunk, tokens))
+
+    merged: list[tuple[str, int]] = []
+    for piece, tokens in pieces:
+        if merged:
+            prev, prev_tokens = merged[-1]
+            # 当前块或上一个块是碎片，且合并后不超长时合并（+1 为换行符）
+            if (tokens < min_tokens or prev_tokens < min_tokens) and prev_tokens + tokens + 1 <= chunk_size:
+                merged[-1] = (f"{prev}\n{piece}", prev_tokens + tokens + 1)
+                continue
+        merged.append((piece, tokens))
+    return [piece for piece, _ in merged]
+
+
 async def chunk_text(
     text: str,
     mode: str = "sliding",
@@ -73,7 +106,7 @@ async def chunk_text(
     elif mode == "semantic":
         return await semantic_chunk(text, model_provider)
     elif mode == "hybrid":
-        # 先语义分块，再对超长块滑动裁剪（semantic_chunk 内部已处理）
-        return await semantic_chunk(text, model_provider)
+        # 先语义分块，再对超长块滑动裁剪、合并过小的碎片
+        return bound_chunks(await semantic_chunk(text, model_provider), chunk_size, overlap)
     else:
         return sliding_window_chunk(text, chunk_size, overlap)
@@ -0,0 +1,113 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import config
+
+# 本地 chunk 文本存储（追加写入、mmap 读取）：
+#   chunks.dat  UTF-8 文本依次追加
+#   chunks.idx  定长索引，第 i 条记录 = chunk id i 的 (offset, length)
+# 启用后 Milvus 的 content 字段只保存引用 "chunkstore://<id>"，检索结果从本地回填文本。
+# 引用随 content 字段一起复制，collection 迁移 / 快照导入后依然有效。
+REF_PREFIX = "chunkstore://"
+_INDEX_ENTRY = struct.Struct("<QQ")
+
+_lock = threading.Lock()
+# 只读映射，其他 worker 追加后按需重新映射
+_maps: dict[str, mmap.mmap | None] = {"dat": None, "idx": None}
+
+
+def _path(name: str) -> str:
+    return os.path.join(config.CHUNK_STORE_DIR, f"chunks.{name}")
+
+
+def make_ref(chunk_id: int) -> str:
+    return f"{REF_PREFIX}{chunk_id}"
+
+
+def is_ref(content: str | None) -> bool:
+    return bool(content) and content.startswith(REF_PREFIX)
+
+
+def append(texts: list[str]) -> list[int]:
+    """追加一批 chunk 文本，返回分配的 chunk id（跨 worker 通过文件锁串行化）"""
+    if not texts:
+        return []
+    os.makedirs(config.CHUNK_STORE_DIR, exist_ok=True)
+    with _lock, open(_path("lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with open(_path("dat"), "ab") as dat, open(_path("idx"), "ab") as idx:
+                offset = dat.seek(0, os.SEEK_END)
+                first_id = idx.seek(0, os.SEEK_END) // _INDEX_ENTRY.size
+                entries = []
+                for text in texts:
+                    data = text.encode("utf-8")
+                    dat.write(data)
+                    entries.append(_INDEX_ENTRY.pack(offset, len(data)))
+                    offset += len(data)
+                # 先落盘文本再写索引，索引可见时文本一定完整
+                dat.flush()
+                os.fsync(dat.fileno())
+                idx.write(b"".join(entries))
+                idx.flush()
+                os.fsync(idx.fileno())
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return list(range(first_id, first_id + len(texts)))
+
+
+def _remap(name: str) -> mmap.mmap | None:
+    old = _maps[name]
+    if old is not None:
+        old.close()
+    _maps[name] = None
+    path = _path(name)
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, "rb") as f:
+            _maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return _maps[name]
+
+
+def get(chunk_ids: list[int]) -> list[str | None]:
+    """按 chunk id 读取文本，不存在的 id 返回 None"""
+    with _lock:
+        idx = _maps["idx"]
+        if idx is None or max(chunk_ids, default=-1) >= len(idx) // _INDEX_ENTRY.size:
+            idx = _remap("idx")
+            dat = _remap("dat")
+        else:
+            dat = _maps["dat"]
+        if idx is None or dat is None:
+            return [None] * len(chunk_ids)
+
+        count = len(idx) // _INDEX_ENTRY.size
+        texts: list[str | None] = []
+        for chunk_id in chunk_ids:
+            if not 0 <= chunk_id < count:
+                texts.append(None)
+                continue
+            offset, length = _INDEX_ENTRY.unpack_from(idx, chunk_id * _INDEX_ENTRY.size)
+            texts.append(dat[offset:offset + length].decode("utf-8"))
+        return texts
+
+
+def resolve(contents: list[str]) -> list[str]:
+    """把 content 字段中的引用替换为文本（普通文本原样返回）"""
+    refs = [i for i, content in enumerate(contents) if is_ref(content)]
+    if not refs:
+        return contents
+    texts = get([int(contents[i][len(REF_PREFIX):]) for i in refs])
+    resolved = list(contents)
+    for i, text in zip(refs, texts):
+        resolved[i] = text if text is not None else ""
+    return resolved
+
+
+def hydrate(rows: list[dict]) -> list[dict]:
+    """原地回填命中结果 / 查询记录的 content 字段"""
+    contents = resolve([row.get("content") for row in rows])
+    for row, content in zip(rows, contents):
+        row["content"] = content
+    return rows
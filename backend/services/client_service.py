@@ -0,0 +1,50 @@
+import os
+from typing import TYPE_CHECKING
+import config
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncOpenAI
+
+# embedding_service / llm_service 共享：同一 provider 的 embedding 和 chat 请求复用一个 client（一个 HTTP 连接池）
+
+
+def _make_http_client() -> "httpx.AsyncClient | None":
+    """If http_proxy is set, return an httpx client that uses it."""
+    proxy = os.environ.get("http_proxy") or os.environ.get("https_proxy")
+    if proxy:
+        import httpx
+
+        return httpx.AsyncClient(proxy=proxy)
+    return None
+
+
+# 按 (api_key, base_url) 复用 client，保持 HTTP 连接池
+_clients: dict[tuple[str, str], "AsyncOpenAI"] = {}
+
+
+def get_client(model_provider: str) -> "AsyncOpenAI":
+    """返回 provider 对应的 client（settings 热更新后 api_key / base_url 变化时新建）"""
+    if model_provider == "bailian":
+        api_key, base_url = config.BAILIAN_API_KEY, config.BAILIAN_BASE_URL
+    else:
+        api_key, base_url = config.OPENAI_API_KEY, config.OPENAI_BASE_URL
+
+    client = _clients.get((api_key, base_url))
+    if client is None:
+        from openai import AsyncOpenAI
+
+        http_client = _make_http_client()
+        client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,  # 重试由 rate_limit_service 统一处理
+            **({"http_client": http_client} if http_client else {}),
+        )
+        _clients[(api_key, base_url)] = client
+    return client
+
+
+async def warmup_client(model_provider: str):
+    """预热：创建 client 并发起一次轻量请求以建立连接池"""
+    await get_client(model_provider).models.list()
@@ -0,0 +1,215 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+import config
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# MinHash 使用的梅森素数 2^31 - 1（a * h 不会溢出 uint64）
+_PRIME = (1 << 31) - 1
+
+_lock = threading.Lock()
+_conn: sqlite3.Connection | None = None
+_perm: tuple["np.ndarray", "np.ndarray"] | None = None
+
+
+@dataclass
+class DedupResult:
+    signatures: list["np.ndarray"]
+    # 与 chunks 对齐；None 表示非重复，否则为 {"doc_id", "chunk_index", "similarity"}
+    duplicates: list[dict | None] = field(default_factory=list)
+
+    @property
+    def duplicate_count(self) -> int:
+        return sum(1 for d in self.duplicates if d is not None)
+
+
+def _connect() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(config.DEDUP_DB_PATH), exist_ok=True)
+        conn = sqlite3.connect(config.DEDUP_DB_PATH, check_same_thread=False, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS signatures ("
+            "scope TEXT NOT NULL, doc_id TEXT NOT NULL, chunk_index INTEGER NOT NULL, signature BLOB NOT NULL, "
+            "PRIMARY KEY (scope, doc_id, chunk_index))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "scope TEXT NOT NULL, band INTEGER NOT NULL, hash TEXT NOT NULL, "
+            "doc_id TEXT NOT NULL, chunk_index INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_buckets_lookup ON buckets (scope, band, hash)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_buckets_doc ON buckets (doc_id)")
+        # 被跳过的重复块 -> 其指向的已入库块；目标文档删除前据此把重复块补回向量库
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS links ("
+            "scope TEXT NOT NULL, doc_id TEXT NOT NULL, chunk_index INTEGER NOT NULL, "
+            "target_doc_id TEXT NOT NULL, target_chunk_index INTEGER NOT NULL, content TEXT NOT NULL, "
+            "PRIMARY KEY (scope, doc_id, chunk_index))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_links_target ON links (target_doc_id)")
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def _permutations() -> tuple["np.ndarray", "np.ndarray"]:
+    """固定种子的 MinHash 哈希参数（跨进程、跨重启一致）"""
+    global _perm
+    if _perm is None:
+        import numpy as np
+
+        rng = np.random.default_rng(1)
+        a = rng.integers(1, _PRIME, size=config.DEDUP_NUM_PERM, dtype=np.uint64)
+        b = rng.integers(0, _PRIME, size=config.DEDUP_NUM_PERM, dtype=np.uint64)
+        _perm = (a, b)
+    return _perm
+
+
+def minhash(text: str) -> "np.ndarray":
+    """字符 n-gram shingle 的 MinHash 签名（中英文通用）"""
+    import numpy as np
+
+    normalized = " ".join(text.split()).casefold()
+    n = config.DEDUP_SHINGLE_SIZE
+    shingles = {normalized[i:i + n] for i in range(max(1, len(normalized) - n + 1))}
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    ) % _PRIME
+    a, b = _permutations()
+    return (((a[:, None] * hashes[None, :]) + b[:, None]) % _PRIME).min(axis=1).astype(np.uint32)
+
+
+def _band_hashes(signature: "np.ndarray") -> list[str]:
+    rows = config.DEDUP_NUM_PERM // config.DEDUP_BANDS
+    return [
+        hashlib.blake2b(signature[i * rows:(i + 1) * rows].tobytes(), digest_size=8).hexdigest()
+        for i in range(config.DEDUP_BANDS)
+    ]
+
+
+def _similarity(sig_a: "np.ndarray", sig_b: "np.ndarray") -> float:
+    """由 MinHash 签名估算 Jaccard 相似度"""
+    return float((sig_a == sig_b).mean())
+
+
+def find_near_duplicates(chunks: list[str], scope: str) -> DedupResult:
+    """对每个 chunk 计算 MinHash，通过 LSH 在持久化索引（同一 scope）和本次上传中查找近重复"""
+    import numpy as np
+
+    signatures = [minhash(chunk) for chunk in chunks]
+    result = DedupResult(signatures=signatures)
+    # 本次上传内的 LSH 桶：(band, hash) -> [chunk 下标]
+    local_buckets: dict[tuple[int, str], list[int]] = {}
+
+    with _lock:
+        conn = _connect()
+        for i, signature in enumerate(signatures):
+            bands = _band_hashes(signature)
+            best: dict | None = None
+
+            # 1. 知识库中已有的 chunk
+            candidates: set[tuple[str, int]] = set()
+            for band, h in enumerate(bands):
+                rows = conn.execute(
+                    "SELECT doc_id, chunk_index FROM buckets WHERE scope = ? AND band = ? AND hash = ?",
+                    (scope, band, h),
+                ).fetchall()
+                candidates.update(rows)
+            for doc_id, chunk_index in candidates:
+                row = conn.execute(
+                    "SELECT signature FROM signatures WHERE scope = ? AND doc_id = ? AND chunk_index = ?",
+                    (scope, doc_id, chunk_index),
+                ).fetchone()
+                if row is None:
+                    continue
+                sim = _similarity(signature, np.frombuffer(row[0], dtype=np.uint32))
+                if sim >= config.DEDUP_THRESHOLD and (best is None or sim > best["similarity"]):
+                    best = {"doc_id": doc_id, "chunk_index": chunk_index, "similarity": round(sim, 4)}
+
+            # 2. 本次上传中更早的 chunk
+            local_candidates = {j for band, h in enumerate(bands) for j in local_buckets.get((band, h), [])}
+            for j in local_candidates:
+                sim = _similarity(signature, signatures[j])
+                if sim >= config.DEDUP_THRESHOLD and (best is None or sim > best["similarity"]):
+                    best = {"doc_id": None, "chunk_index": j, "similarity": round(sim, 4)}
+
+            result.duplicates.append(best)
+            if best is None:
+                for band, h in enumerate(bands):
+                    local_buckets.setdefault((band, h), []).append(i)
+
+    return result
+
+
+def index_chunks(scope: str, doc_id: str, chunk_indexes: list[int], signatures: list["np.ndarray"]):
+    """将已写入向量库的 chunk 签名加入持久化 LSH 索引"""
+    with _lock:
+        conn = _connect()
+        for chunk_index, signature in zip(chunk_indexes, signatures):
+            conn.execute(
+                "INSERT OR REPLACE INTO signatures (scope, doc_id, chunk_index, signature) VALUES (?, ?, ?, ?)",
+                (scope, doc_id, chunk_index, signature.tobytes()),
+            )
+            conn.executemany(
+                "INSERT INTO buckets (scope, band, hash, doc_id, chunk_index) VALUES (?, ?, ?, ?, ?)",
+                [(scope, band, h, doc_id, chunk_index) for band, h in enumerate(_band_hashes(signature))],
+            )
+        conn.commit()
+
+
+def link_duplicates(scope: str, doc_id: str, duplicates: list[dict]):
+    """记录被跳过的重复块指向的其他文档块（指向本文档的无需记录，会随文档一起删除）"""
+    rows = [
+        (scope, doc_id, dup["index"], dup["duplicate_of"]["doc_id"], dup["duplicate_of"]["chunk_index"], dup["content"])
+        for dup in duplicates
+        if dup["duplicate_of"]["doc_id"] != doc_id
+    ]
+    with _lock:
+        conn = _connect()
+        conn.executemany(
+            "INSERT OR REPLACE INTO links "
+            "(scope, doc_id, chunk_index, target_doc_id, target_chunk_index, content) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.commit()
+
+
+def dependents(doc_id: str) -> list[dict]:
+    """其他文档中指向该文档、自身未入库的重复块"""
+    with _lock:
+        rows = _connect().execute(
+            "SELECT scope, doc_id, chunk_index, content FROM links WHERE target_doc_id = ? AND doc_id != ? "
+            "ORDER BY doc_id, chunk_index",
+            (doc_id, doc_id),
+        ).fetchall()
+    return [{"scope": r[0], "doc_id": r[1], "chunk_index": r[2], "content": r[3]} for r in rows]
+
+
+def unlink(scope: str, doc_id: str, chunk_indexes: list[int]):
+    """重复块已补回向量库后删除其链接"""
+    with _lock:
+        conn = _connect()
+        conn.executemany(
+            "DELETE FROM links WHERE scope = ? AND doc_id = ? AND chunk_index = ?",
+            [(scope, doc_id, i) for i in chunk_indexes],
+        )
+        conn.commit()
+
+
+def remove_document(doc_id: str):
+    """删除文档的签名和链接；其他文档指向它的重复块需先通过 dependents() 补回"""
+    with _lock:
+        conn = _connect()
+        conn.execute("DELETE FROM signatures WHERE doc_id = ?", (doc_id,))
+        conn.execute("DELETE FROM buckets WHERE doc_id = ?", (doc_id,))
+        conn.execute("DELETE FROM links WHERE doc_id = ? OR target_doc_id = ?", (doc_id, doc_id))
+        conn.commit()
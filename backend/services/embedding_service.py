@@ -1,52 +1,68 @@
-import os
-import httpx
-from openai import AsyncOpenAI
+import asyncio
+from typing import TYPE_CHECKING
 import config
+from services.rate_limit_service import get_limiter, estimate_tokens
+from services.profile_service import span
+from services.client_service import get_client
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
 
-def _make_http_client() -> httpx.AsyncClient | None:
-    """If http_proxy is set, return an httpx client that uses it."""
-    proxy = os.environ.get("http_proxy") or os.environ.get("https_proxy")
-    if proxy:
-        return httpx.AsyncClient(proxy=proxy)
-    return None
 
-
-def _get_client(model_provider: str) -> tuple[AsyncOpenAI, str]:
+def _get_client(model_provider: str) -> tuple["AsyncOpenAI", str]:
     """根据 provider 返回对应的 client 和 model 名"""
-    http_client = _make_http_client()
     if model_provider == "bailian":
-        client = AsyncOpenAI(
-            api_key=config.BAILIAN_API_KEY,
-            base_url=config.BAILIAN_BASE_URL,
-            **({"http_client": http_client} if http_client else {}),
-        )
-        model = config.BAILIAN_EMBEDDING_MODEL
-    else:
-        client = AsyncOpenAI(
-            api_key=config.OPENAI_API_KEY,
-            base_url=config.OPENAI_BASE_URL,
-            **({"http_client": http_client} if http_client else {}),
-        )
-        model = config.OPENAI_EMBEDDING_MODEL
-    return client, model
+        return get_client(model_provider), config.BAILIAN_EMBEDDING_MODEL
+    return get_client(model_provider), config.OPENAI_EMBEDDING_MODEL
+
+
+def _dimension_kwargs(model_provider: str, dimensions: int | None) -> dict:
+    """text-embedding-3 系列（openai）通过 dimensions 参数原生降维"""
+    if dimensions and model_provider == "openai" and dimensions != config.EMBEDDING_DIM["openai"]:
+        return {"dimensions": dimensions}
+    return {}
+
 
+def fit_dimensions(vector: list[float], dimensions: int | None) -> list[float]:
+    """截断到目标维度并重新 L2 归一化（不支持 dimensions 参数的模型）"""
+    if not dimensions or len(vector) <= dimensions:
+        return vector
+    truncated = vector[:dimensions]
+    norm = sum(v * v for v in truncated) ** 0.5 or 1.0
+    return [v / norm for v in truncated]
 
-async def generate_embedding(text: str, model_provider: str = "openai") -> list[float]:
-    """生成单条文本的 embedding"""
+
+async def generate_embedding(
+    text: str, model_provider: str = "openai", dimensions: int | None = None
+) -> list[float]:
+    """生成单条文本的 embedding；dimensions 为目标维度（None 为模型原生维度）"""
     client, model = _get_client(model_provider)
-    response = await client.embeddings.create(
-        input=text,
-        model=model,
-    )
-    return response.data[0].embedding
+    with span(f"embedding:{model_provider}"):
+        response = await get_limiter(model_provider).run(
+            lambda: client.embeddings.create(input=text, model=model, **_dimension_kwargs(model_provider, dimensions)),
+            tokens=estimate_tokens([text]),
+        )
+    return fit_dimensions(response.data[0].embedding, dimensions)
 
 
-async def generate_embeddings(texts: list[str], model_provider: str = "openai") -> list[list[float]]:
-    """批量生成 embedding"""
+async def generate_embeddings(
+    texts: list[str], model_provider: str = "openai", dimensions: int | None = None
+) -> list[list[float]]:
+    """批量生成 embedding（超过 provider 单次上限时自动分批，批次由限流器调度并发执行）"""
     client, model = _get_client(model_provider)
-    response = await client.embeddings.create(
-        input=texts,
-        model=model,
+    limiter = get_limiter(model_provider)
+    batch_size = config.EMBEDDING_BATCH_SIZE.get(model_provider, 25)
+    dimension_kwargs = _dimension_kwargs(model_provider, dimensions)
+
+    async def _embed_batch(batch: list[str]) -> list[list[float]]:
+        with span(f"embedding_batch:{model_provider}"):
+            response = await limiter.run(
+                lambda: client.embeddings.create(input=batch, model=model, **dimension_kwargs),
+                tokens=estimate_tokens(batch),
+            )
+        return [fit_dimensions(item.embedding, dimensions) for item in response.data]
+
+    results = await asyncio.gather(
+        *(_embed_batch(texts[start:start + batch_size]) for start in range(0, len(texts), batch_size))
     )
-    return [item.embedding for item in response.data]
+    return [vec for batch_vectors in results for vec in batch_vectors]
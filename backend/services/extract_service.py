@@ -1,7 +1,3 @@
-import pdfplumber
-from docx import Document
-
-
 def extract_text(file_path: str, file_type: str) -> str:
     """根据文件类型抽取纯文本"""
     if file_type == "pdf":
@@ -15,6 +11,8 @@ def extract_text(file_path: str, file_type: str) -> str:
 
 
 def _extract_pdf(file_path: str) -> str:
+    import pdfplumber
+
     texts = []
     with pdfplumber.open(file_path) as pdf:
         for page in pdf.pages:
@@ -25,6 +23,8 @@ def _extract_pdf(file_path: str) -> str:
 
 
 def _extract_docx(file_path: str) -> str:
+    from docx import Document
+
     doc = Document(file_path)
     texts = [para.text for para in doc.paragraphs if para.text.strip()]
     return "\n".join(texts)
@@ -0,0 +1,514 @@
+import asyncio
+import fcntl
+import json
+import os
+import shutil
+import traceback
+from contextlib import contextmanager
+from datetime import datetime
+import config
+from models.schema import DocumentInfo
+from services import state_service, dedup_service
+from services.profile_service import span
+from services.extract_service import extract_text
+from services.clean_service import clean_text
+from services.chunk_service import chunk_text, count_tokens
+from services.embedding_service import generate_embeddings
+from services.milvus_service import (
+    insert_chunks,
+    delete_doc_chunks,
+    get_collection_name,
+    list_doc_ids,
+    resolve_collection,
+)
+
+# 文档入库断点（每个文档一个目录，完成后删除）：
+#   job.json             参数与进度：stage、已 embedding / 已写入的批次、正在写入的批次
+#   text.txt             清洗后的文本（stage >= extracted）
+#   chunks.json          分块与近重复检测结果（stage >= chunked）
+#   vectors_{i}.npy      第 i 批 embedding 结果
+#   lock                 处理中的 worker 持有 flock，进程退出后自动释放
+
+
+class IngestError(Exception):
+    """文档本身的问题（内容为空等），重试无意义"""
+
+
+class IngestBusyError(Exception):
+    """该文档正在被其他请求 / worker 处理"""
+
+
+def _job_dir(doc_id: str) -> str:
+    return os.path.join(config.INGEST_CHECKPOINT_DIR, doc_id)
+
+
+def _job_file(doc_id: str, name: str) -> str:
+    return os.path.join(_job_dir(doc_id), name)
+
+
+def _write_json(path: str, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def load_job(doc_id: str) -> dict | None:
+    path = _job_file(doc_id, "job.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_job(job: dict):
+    _write_json(_job_file(job["doc_id"], "job.json"), job)
+
+
+def _register(job: dict, status: str, chunk_count: int = 0, duplicate_count: int = 0):
+    doc_info = DocumentInfo(
+        doc_id=job["doc_id"],
+        filename=job["filename"],
+        chunk_count=chunk_count,
+        status=status,
+        model_provider=job["model_provider"],
+        chunk_mode=job["chunk_mode"],
+        chunk_size=job["chunk_size"],
+        overlap=job["overlap"],
+        duplicate_count=duplicate_count,
+        kb=job["kb"],
+    )
+    state_service.save_document(job["doc_id"], doc_info.model_dump())
+
+
+def create_job(
+    doc_id: str,
+    filename: str,
+    file_ext: str,
+    save_path: str,
+    chunk_mode: str,
+    chunk_size: int,
+    overlap: int,
+    model_provider: str,
+    kb: str | None = None,
+) -> dict:
+    """创建入库任务并先在注册表登记为 processing，孤儿清理不会误删处理中的向量"""
+    os.makedirs(_job_dir(doc_id), exist_ok=True)
+    job = {
+        "doc_id": doc_id,
+        "filename": filename,
+        "file_ext": file_ext,
+        "save_path": save_path,
+        "chunk_mode": chunk_mode,
+        "chunk_size": chunk_size,
+        "overlap": overlap,
+        "model_provider": model_provider,
+        "kb": kb,
+        "stage": "uploaded",
+        "batches": 0,
+        "inserted": [],
+        "inserting": None,
+        "error": None,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    _save_job(job)
+    _register(job, "processing")
+    return job
+
+
+def list_jobs() -> list[dict]:
+    if not os.path.isdir(config.INGEST_CHECKPOINT_DIR):
+        return []
+    jobs = []
+    for doc_id in sorted(os.listdir(config.INGEST_CHECKPOINT_DIR)):
+        job = load_job(doc_id)
+        if job is not None:
+            jobs.append(job)
+    return jobs
+
+
+def discard_job(doc_id: str):
+    shutil.rmtree(_job_dir(doc_id), ignore_errors=True)
+
+
+def remove_document_files(doc_id: str):
+    """删除文档的分块结果文件和入库断点"""
+    for ext in ("json", "md", "npy"):
+        path = os.path.join(config.CHUNK_RESULTS_DIR, f"{doc_id}.{ext}")
+        if os.path.exists(path):
+            os.remove(path)
+    discard_job(doc_id)
+
+
+@contextmanager
+def _job_lock(doc_id: str):
+    with open(_job_file(doc_id, "lock"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise IngestBusyError(f"文档 {doc_id} 正在处理中")
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _save_vectors(path: str, vectors: list[list[float]]):
+    import numpy as np
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.asarray(vectors, dtype=np.float32))
+    os.replace(tmp_path, path)
+
+
+def _load_vectors(path: str) -> list[list[float]]:
+    import numpy as np
+
+    return np.load(path).tolist()
+
+
+async def run_job(doc_id: str) -> dict:
+    """执行（或从断点继续）入库任务，返回上传接口的响应内容；失败时保留断点供重试"""
+    if load_job(doc_id) is None:
+        raise FileNotFoundError(f"入库任务不存在: {doc_id}")
+    with _job_lock(doc_id):
+        job = load_job(doc_id)
+        if job is None:
+            # 等锁期间已被其他 worker 完成
+            raise FileNotFoundError(f"入库任务不存在: {doc_id}")
+        try:
+            return await _run_stages(job)
+        except IngestError:
+            discard_job(doc_id)
+            state_service.delete_document(doc_id)
+            raise
+        except BaseException as e:
+            job["error"] = str(e) or type(e).__name__
+            _save_job(job)
+            _register(job, "failed")
+            raise
+
+
+async def _run_stages(job: dict) -> dict:
+    doc_id = job["doc_id"]
+    model_provider, kb = job["model_provider"], job["kb"]
+    job["error"] = None
+    _register(job, "processing")
+
+    # 1. 抽取 + 清洗文本
+    text_path = _job_file(doc_id, "text.txt")
+    if job["stage"] == "uploaded":
+        with span("ingest.extract"):
+            cleaned = clean_text(extract_text(job["save_path"], job["file_ext"]))
+        if not cleaned.strip():
+            raise IngestError("文档内容为空")
+        with open(text_path, "w", encoding="utf-8") as f:
+            f.write(cleaned)
+        job["stage"] = "extracted"
+        _save_job(job)
+
+    # 2. 分块 + 近重复检测（检测结果随分块一起固定，重试时不受期间新入库文档影响）
+    chunks_path = _job_file(doc_id, "chunks.json")
+    if job["stage"] == "extracted":
+        with open(text_path, "r", encoding="utf-8") as f:
+            cleaned = f.read()
+        with span("ingest.chunk"):
+            chunks = await chunk_text(
+                cleaned,
+                mode=job["chunk_mode"],
+                chunk_size=job["chunk_size"],
+                overlap=job["overlap"],
+                model_provider=model_provider,
+            )
+        if not chunks:
+            raise IngestError("文档内容为空，无法分块")
+
+        chunk_indexes = list(range(len(chunks)))
+        duplicates: list[dict] = []
+        if config.DEDUP_MODE != "off":
+            # SQLite LSH 查询为同步 IO，放到线程中执行
+            with span("ingest.dedup"):
+                dedup = await asyncio.to_thread(
+                    dedup_service.find_near_duplicates, chunks, get_collection_name(model_provider, kb)
+                )
+            chunk_indexes = [i for i, dup in enumerate(dedup.duplicates) if dup is None]
+            duplicates = [
+                {"index": i, "content": chunks[i], "duplicate_of": {**dup, "doc_id": dup["doc_id"] or doc_id}}
+                for i, dup in enumerate(dedup.duplicates)
+                if dup is not None
+            ]
+        _write_json(chunks_path, {"chunks": chunks, "chunk_indexes": chunk_indexes, "duplicates": duplicates})
+        job["batches"] = -(-len(chunk_indexes) // config.INGEST_BATCH_SIZE)
+        job["stage"] = "chunked"
+        _save_job(job)
+
+    with open(chunks_path, "r", encoding="utf-8") as f:
+        chunk_data = json.load(f)
+    chunks, chunk_indexes, duplicates = chunk_data["chunks"], chunk_data["chunk_indexes"], chunk_data["duplicates"]
+    unique_chunks = [chunks[i] for i in chunk_indexes]
+    batch_size = config.INGEST_BATCH_SIZE
+
+    def _batch(i: int) -> list[str]:
+        return unique_chunks[i * batch_size:(i + 1) * batch_size]
+
+    # 3. 生成 embedding：未完成的批次并发执行（由限流器调度），每批完成即落盘
+    _, dim = resolve_collection(model_provider, kb)
+    pending = [i for i in range(job["batches"]) if not os.path.exists(_job_file(doc_id, f"vectors_{i}.npy"))]
+
+    async def _embed(i: int):
+        vectors = await generate_embeddings(_batch(i), model_provider=model_provider, dimensions=dim)
+        _save_vectors(_job_file(doc_id, f"vectors_{i}.npy"), vectors)
+
+    results = await asyncio.gather(*(_embed(i) for i in pending), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    # 4. 写入 Milvus：上次中断在某批写入过程中时，无法确认该批是否已落库，清空本文档向量后整体重写
+    if job["inserting"] is not None:
+        delete_doc_chunks(doc_id, model_provider=model_provider, kb=kb)
+        job["inserted"] = []
+        job["inserting"] = None
+        _save_job(job)
+    for i in range(job["batches"]):
+        if i in job["inserted"]:
+            continue
+        job["inserting"] = i
+        _save_job(job)
+        insert_chunks(doc_id, _batch(i), _load_vectors(_job_file(doc_id, f"vectors_{i}.npy")), model_provider=model_provider, kb=kb)
+        job["inserted"].append(i)
+        job["inserting"] = None
+        _save_job(job)
+
+    # 5. 近重复索引与链接、分块结果、注册表
+    if config.DEDUP_MODE != "off":
+        scope = get_collection_name(model_provider, kb)
+        await asyncio.to_thread(
+            dedup_service.index_chunks,
+            scope,
+            doc_id,
+            chunk_indexes,
+            [dedup_service.minhash(chunks[i]) for i in chunk_indexes],
+        )
+        await asyncio.to_thread(dedup_service.link_duplicates, scope, doc_id, duplicates)
+    vectors = [vec for i in range(job["batches"]) for vec in _load_vectors(_job_file(doc_id, f"vectors_{i}.npy"))]
+    save_chunk_results(
+        doc_id=doc_id,
+        filename=job["filename"],
+        chunks=unique_chunks,
+        vectors=vectors,
+        chunk_mode=job["chunk_mode"],
+        chunk_size=job["chunk_size"],
+        overlap=job["overlap"],
+        model_provider=model_provider,
+        chunk_indexes=chunk_indexes,
+        duplicates=duplicates if config.DEDUP_MODE == "link" else [],
+        dim=dim,
+    )
+    _register(job, "completed", chunk_count=len(unique_chunks), duplicate_count=len(duplicates))
+    discard_job(doc_id)
+
+    return {
+        "doc_id": doc_id,
+        "filename": job["filename"],
+        "chunk_count": len(unique_chunks),
+        "duplicate_count": len(duplicates),
+        "duplicate_rate": round(len(duplicates) / len(chunks), 4),
+        "status": "completed",
+        "model_provider": model_provider,
+        "kb": kb,
+    }
+
+
+async def materialize_dependents(doc_id: str) -> int:
+    """删除文档前，把其他文档中指向它而未入库的重复块重新 embedding 并写入各自文档，返回补回的块数"""
+    items = await asyncio.to_thread(dedup_service.dependents, doc_id)
+    groups: dict[tuple[str, str], list[dict]] = {}
+    for item in items:
+        groups.setdefault((item["scope"], item["doc_id"]), []).append(item)
+
+    restored = 0
+    for (scope, dep_doc_id), group in groups.items():
+        info = state_service.get_document(dep_doc_id)
+        if info is None:
+            continue
+        model_provider, kb = info["model_provider"], info.get("kb")
+        indexes = [item["chunk_index"] for item in group]
+        texts = [item["content"] for item in group]
+        _, dim = resolve_collection(model_provider, kb)
+        vectors = await generate_embeddings(texts, model_provider=model_provider, dimensions=dim)
+        insert_chunks(dep_doc_id, texts, vectors, model_provider=model_provider, kb=kb)
+        await asyncio.to_thread(
+            dedup_service.index_chunks, scope, dep_doc_id, indexes, [dedup_service.minhash(t) for t in texts]
+        )
+        await asyncio.to_thread(dedup_service.unlink, scope, dep_doc_id, indexes)
+        _append_chunk_results(dep_doc_id, indexes, texts, vectors)
+
+        info["chunk_count"] = info.get("chunk_count", 0) + len(texts)
+        info["duplicate_count"] = max(0, info.get("duplicate_count", 0) - len(texts))
+        state_service.save_document(dep_doc_id, info)
+        restored += len(texts)
+    return restored
+
+
+def _append_chunk_results(doc_id: str, indexes: list[int], texts: list[str], vectors: list[list[float]]):
+    """补回的块追加到分块结果（JSON chunks 与 .npy 按行对齐），并从重复块列表中移除"""
+    import numpy as np
+
+    json_path = os.path.join(config.CHUNK_RESULTS_DIR, f"{doc_id}.json")
+    if os.path.exists(json_path):
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for i, text, vec in zip(indexes, texts, vectors):
+            data["chunks"].append({
+                "index": i,
+                "token_count": count_tokens(text),
+                "char_count": len(text),
+                "content": text,
+                "embedding_dim": len(vec),
+                "embedding_preview": [round(v, 6) for v in vec[:8]],
+            })
+        data["total_chunks"] = len(data["chunks"])
+        if "duplicates" in data:
+            restored = set(indexes)
+            data["duplicates"] = [dup for dup in data["duplicates"] if dup["index"] not in restored]
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    npy_path = os.path.join(config.CHUNK_RESULTS_DIR, f"{doc_id}.npy")
+    new_rows = np.asarray(vectors, dtype=np.float32)
+    if os.path.exists(npy_path):
+        existing = np.load(npy_path)
+        if existing.size:
+            new_rows = np.vstack([existing, new_rows])
+    np.save(npy_path, new_rows)
+
+
+async def resume_pending():
+    """启动时继续未完成的入库任务（其他 worker 正在处理的任务跳过）"""
+    from services import warmup_service
+
+    while not warmup_service.is_ready():
+        await asyncio.sleep(1)
+    for job in list_jobs():
+        try:
+            await run_job(job["doc_id"])
+        except (IngestBusyError, IngestError, FileNotFoundError):
+            continue
+        except Exception:
+            # run_job 已把错误写入任务并将文档标记为 failed
+            traceback.print_exc()
+
+
+def sweep_orphans(dry_run: bool = False) -> dict[str, list[str]]:
+    """清理 Milvus 中没有注册表记录的 doc_id（入库中途失败遗留的向量），返回 {collection: [doc_id]}
+
+    文档在写入向量前就已注册，因此先列出 Milvus 中的 doc_id、再读注册表，
+    并在删除前逐个复核，与其他 worker 上正在进行的入库并发运行也不会误删。
+    """
+    targets = [(provider, None) for provider in ("openai", "bailian")]
+    targets += [(kb["model_provider"], kb["name"]) for kb in state_service.list_kbs()]
+
+    removed: dict[str, list[str]] = {}
+    for model_provider, kb in targets:
+        doc_ids = list_doc_ids(model_provider, kb)
+        registered = {doc["doc_id"] for doc in state_service.list_documents()}
+        orphans = sorted(doc_ids - registered)
+        if not dry_run:
+            orphans = [doc_id for doc_id in orphans if state_service.get_document(doc_id) is None]
+            for doc_id in orphans:
+                delete_doc_chunks(doc_id, model_provider=model_provider, kb=kb)
+                dedup_service.remove_document(doc_id)
+        if orphans:
+            removed[resolve_collection(model_provider, kb)[0]] = orphans
+    return removed
+
+
+def save_chunk_results(
+    doc_id: str,
+    filename: str,
+    chunks: list[str],
+    vectors: list[list[float]],
+    chunk_mode: str,
+    chunk_size: int,
+    overlap: int,
+    model_provider: str,
+    chunk_indexes: list[int] | None = None,
+    duplicates: list[dict] | None = None,
+    dim: int | None = None,
+):
+    """将分块结果保存为 JSON + Markdown + .npy 文件（chunk_indexes 为各块在原文档中的序号，dim 为向量维度）"""
+    if chunk_indexes is None:
+        chunk_indexes = list(range(len(chunks)))
+    duplicates = duplicates or []
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    chunk_results_dir = config.CHUNK_RESULTS_DIR
+
+    # --- JSON 文件（结构化数据，含 embedding 前 8 维） ---
+    json_data = {
+        "doc_id": doc_id,
+        "filename": filename,
+        "created_at": now,
+        "config": {
+            "chunk_mode": chunk_mode,
+            "chunk_size": chunk_size,
+            "overlap": overlap,
+            "model_provider": model_provider,
+        },
+        "total_chunks": len(chunks),
+        "chunks": [],
+    }
+    if duplicates:
+        json_data["duplicates"] = duplicates
+    for i, text, vec in zip(chunk_indexes, chunks, vectors):
+        json_data["chunks"].append({
+            "index": i,
+            "token_count": count_tokens(text),
+            "char_count": len(text),
+            "content": text,
+            "embedding_dim": len(vec),
+            "embedding_preview": [round(v, 6) for v in vec[:8]],
+        })
+
+    json_path = os.path.join(chunk_results_dir, f"{doc_id}.json")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(json_data, f, ensure_ascii=False, indent=2)
+
+    # --- Markdown 文件（人类可读） ---
+    lines = [
+        f"# 分块结果：{filename}",
+        "",
+        f"- **文档 ID**: `{doc_id}`",
+        f"- **处理时间**: {now}",
+        f"- **分块模式**: {chunk_mode}",
+        f"- **Chunk Size**: {chunk_size}",
+        f"- **Overlap**: {overlap}",
+        f"- **模型**: {model_provider}",
+        f"- **总分块数**: {len(chunks)}",
+        "",
+        "---",
+        "",
+    ]
+    for i, text, vec in zip(chunk_indexes, chunks, vectors):
+        lines.append(f"## Chunk {i} ({count_tokens(text)} tokens, {len(text)} chars)")
+        lines.append("")
+        lines.append(f"**Embedding** ({len(vec)}d): `[{', '.join(f'{v:.4f}' for v in vec[:6])}  ...]`")
+        lines.append("")
+        lines.append("```")
+        lines.append(text)
+        lines.append("```")
+        lines.append("")
+
+    md_path = os.path.join(chunk_results_dir, f"{doc_id}.md")
+    with open(md_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+    # --- 完整向量（float32 .npy，与 JSON 中的 chunks 按行对齐，用于快照导出 / 离线重建） ---
+    # 没有分块（如全部为重复块）时也写出 (0, dim) 数组，导出时不会误判为文件缺失
+    import numpy as np
+
+    if dim is None:
+        dim = len(vectors[0]) if vectors else 0
+    array = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), dim)
+    np.save(os.path.join(chunk_results_dir, f"{doc_id}.npy"), array)
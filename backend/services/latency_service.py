@@ -0,0 +1,80 @@
+import asyncio
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Any
+import config
+
+
+class Deadline:
+    """单次请求的延迟预算"""
+
+    def __init__(self, budget_ms: int):
+        self.budget_ms = budget_ms
+        self._expires_at = time.monotonic() + budget_ms / 1000
+
+    def remaining(self) -> float:
+        """剩余预算（秒），不小于 0"""
+        return max(0.0, self._expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+# 各阶段最近的耗时样本（秒），用于计算对冲延迟
+_samples: dict[str, deque[float]] = {}
+
+
+def record_latency(stage: str, seconds: float):
+    samples = _samples.get(stage)
+    if samples is None:
+        samples = _samples[stage] = deque(maxlen=config.HEDGE_SAMPLE_WINDOW)
+    samples.append(seconds)
+
+
+def latency_percentile(stage: str, percentile: float) -> float | None:
+    """返回某阶段的历史耗时分位数（秒），样本不足时返回 None"""
+    samples = _samples.get(stage)
+    if not samples or len(samples) < config.HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+    return ordered[index]
+
+
+async def hedged(
+    stage: str,
+    fn: Callable[[], Awaitable[Any]],
+    discard: Callable[[Any], Awaitable[None]] | None = None,
+) -> Any:
+    """对冲调用：首次调用超过该阶段历史 P{HEDGE_PERCENTILE} 耗时仍未返回时，再并发发起一次，取先成功者。
+
+    discard 用于释放落败但已完成的调用结果（如未消费的流式响应）。
+    """
+    delay = latency_percentile(stage, config.HEDGE_PERCENTILE) if config.HEDGE_ENABLED else None
+    start = time.monotonic()
+    tasks = {asyncio.ensure_future(fn())}
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=max(delay, config.HEDGE_MIN_DELAY_MS / 1000))
+            if not done:
+                tasks.add(asyncio.ensure_future(fn()))
+
+        error: BaseException | None = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task
+                elif discard is not None:
+                    await discard(task.result())
+            if winner is not None:
+                record_latency(stage, time.monotonic() - start)
+                return winner.result()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
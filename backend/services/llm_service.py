@@ -1,55 +1,57 @@
-import os
-import httpx
+from typing import TYPE_CHECKING
 from collections.abc import AsyncGenerator
-from openai import AsyncOpenAI
 import config
+from services.cache_service import llm_cache, make_llm_key
+from services.latency_service import hedged
+from services.rate_limit_service import get_limiter, estimate_tokens
+from services.profile_service import span
+from services.client_service import get_client
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
 
-def _make_http_client() -> httpx.AsyncClient | None:
-    """If http_proxy is set, return an httpx client that uses it."""
-    proxy = os.environ.get("http_proxy") or os.environ.get("https_proxy")
-    if proxy:
-        return httpx.AsyncClient(proxy=proxy)
-    return None
 
-
-def _get_chat_client(model_provider: str) -> tuple[AsyncOpenAI, str]:
+def _get_chat_client(model_provider: str) -> tuple["AsyncOpenAI", str]:
     """根据 provider 返回对应的 chat client 和 model 名"""
-    http_client = _make_http_client()
     if model_provider == "bailian":
-        client = AsyncOpenAI(
-            api_key=config.BAILIAN_API_KEY,
-            base_url=config.BAILIAN_BASE_URL,
-            **({"http_client": http_client} if http_client else {}),
-        )
-        model = config.BAILIAN_CHAT_MODEL
-    else:
-        client = AsyncOpenAI(
-            api_key=config.OPENAI_API_KEY,
-            base_url=config.OPENAI_BASE_URL,
-            **({"http_client": http_client} if http_client else {}),
-        )
-        model = config.OPENAI_CHAT_MODEL
-    return client, model
+        return get_client(model_provider), config.BAILIAN_CHAT_MODEL
+    return get_client(model_provider), config.OPENAI_CHAT_MODEL
 
 
 async def call_llm(
     messages: list[dict],
     model_provider: str = "openai",
     temperature: float = 0.7,
+    use_cache: bool = False,
 ) -> str:
-    """调用 LLM 生成回答"""
+    """调用 LLM 生成回答；use_cache=True 时按模型 + 完整 prompt 缓存结果（仅用于确定性调用）"""
     client, model = _get_chat_client(model_provider)
-    response = await client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-    )
-    return response.choices[0].message.content
+    cache_key = None
+    if use_cache and config.LLM_CACHE_ENABLED:
+        cache_key = make_llm_key(model, messages, temperature)
+        cached = llm_cache.get_response(cache_key)
+        if cached is not None:
+            return cached
+
+    with span(f"llm:{model_provider}"):
+        response = await get_limiter(model_provider).run(
+            lambda: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+            ),
+            tokens=estimate_tokens([m["content"] for m in messages]) + config.LLM_COMPLETION_TOKEN_ESTIMATE,
+        )
+    content = response.choices[0].message.content
+    if cache_key is not None and content:
+        llm_cache.set_response(cache_key, content)
+    return content
 
 
-async def generate_answer(question: str, contexts: list[str], model_provider: str = "openai") -> tuple[str, str]:
-    """根据检索到的上下文和问题生成回答，返回 (answer, prompt)"""
+async def generate_answer(
+    question: str, contexts: list[str], model_provider: str = "openai", hedge: bool = False
+) -> tuple[str, str]:
+    """根据检索到的上下文和问题生成回答，返回 (answer, prompt)；hedge=True 时对慢请求做对冲"""
     context_text = "\n".join([f"{i+1}. {ctx}" for i, ctx in enumerate(contexts)])
 
     system_content = (
@@ -64,14 +66,17 @@ async def generate_answer(question: str, contexts: list[str], model_provider: st
     ]
 
     full_prompt = f"[System]\n{system_content}\n\n[User]\n{user_content}"
-    answer = await call_llm(messages, model_provider=model_provider)
+    if hedge:
+        answer = await hedged(f"llm_answer:{model_provider}", lambda: call_llm(messages, model_provider=model_provider))
+    else:
+        answer = await call_llm(messages, model_provider=model_provider)
     return answer, full_prompt
 
 
 async def stream_answer(
-    question: str, contexts: list[str], model_provider: str = "openai"
+    question: str, contexts: list[str], model_provider: str = "openai", hedge: bool = False
 ) -> tuple[AsyncGenerator[str, None], str]:
-    """流式生成回答，返回 (异步生成器, prompt)"""
+    """流式生成回答，返回 (异步生成器, prompt)；hedge=True 时对首 token 做对冲请求"""
     context_text = "\n".join([f"{i+1}. {ctx}" for i, ctx in enumerate(contexts)])
 
     system_content = (
@@ -89,16 +94,46 @@ async def stream_answer(
 
     client, model = _get_chat_client(model_provider)
 
+    async def _open_stream() -> tuple:
+        """发起流式请求并读到第一个有内容的 token，返回 (response, iterator, first_token)"""
+        with span(f"llm_first_token:{model_provider}"):
+            response = await get_limiter(model_provider).run(
+                lambda: client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=0.7,
+                    stream=True,
+                ),
+                tokens=estimate_tokens([m["content"] for m in messages]) + config.LLM_COMPLETION_TOKEN_ESTIMATE,
+            )
+            iterator = response.__aiter__()
+            try:
+                async for chunk in iterator:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        return response, iterator, chunk.choices[0].delta.content
+            except BaseException:
+                await response.close()
+                raise
+            return response, iterator, None
+
+    async def _discard(opened: tuple):
+        await opened[0].close()
+
     async def _generate() -> AsyncGenerator[str, None]:
-        response = await client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.7,
-            stream=True,
-        )
-        async for chunk in response:
-            delta = chunk.choices[0].delta
-            if delta.content:
-                yield delta.content
+        if hedge:
+            response, iterator, first = await hedged(
+                f"llm_first_token:{model_provider}", _open_stream, discard=_discard
+            )
+        else:
+            response, iterator, first = await _open_stream()
+        try:
+            if first:
+                yield first
+            with span(f"llm_stream:{model_provider}"):
+                async for chunk in iterator:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+        finally:
+            await response.close()
 
     return _generate(), full_prompt
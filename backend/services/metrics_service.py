@@ -0,0 +1,16 @@
+import threading
+from collections import Counter
+
+# 进程内计数器（多 worker 时每个 worker 各自计数）
+_lock = threading.Lock()
+_counters: Counter[str] = Counter()
+
+
+def incr(name: str, value: int = 1):
+    with _lock:
+        _counters[name] += value
+
+
+def snapshot() -> dict[str, int]:
+    with _lock:
+        return dict(_counters)
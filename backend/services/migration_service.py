@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import random
+import time
+import config
+from services import state_service, chunk_store_service
+from services.embedding_service import generate_embeddings, fit_dimensions
+from services.milvus_service import (
+    build_collection_index,
+    connect_milvus,
+    create_collection,
+    get_collection_name,
+    resolve_collection,
+)
+
+_COPY_BATCH = 1000
+
+
+def _row_key(doc_id: str, content: str) -> str:
+    """跨 collection 比较命中结果用的 key（auto_id 在新 collection 中会变化）"""
+    return f"{doc_id}:{hashlib.sha1(content.encode('utf-8')).hexdigest()}"
+
+
+async def _copy_rows(src, dst, model_provider: str, target_dim: int, mode: str, after_id: int, sampler) -> tuple[int, int]:
+    """复制 id > after_id 的记录到新 collection，返回 (已复制的最大 id, 复制条数)"""
+    max_id, copied = after_id, 0
+    iterator = src.query_iterator(
+        batch_size=_COPY_BATCH,
+        expr=f"id > {after_id}",
+        output_fields=["id", "doc_id", "content", "vector"],
+    )
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            contents = [row["content"] for row in rows]
+            if mode == "reembed":
+                # content 可能是本地 chunk 存储的引用，embedding 前回填文本；写入新 collection 时保留引用
+                texts = chunk_store_service.resolve(contents)
+                vectors = await generate_embeddings(texts, model_provider=model_provider, dimensions=target_dim)
+            else:
+                vectors = [fit_dimensions([float(v) for v in row["vector"]], target_dim) for row in rows]
+            dst.insert([[row["doc_id"] for row in rows], contents, vectors])
+            for row, vector in zip(rows, vectors):
+                sampler(row, vector)
+            max_id = max(max_id, max(int(row["id"]) for row in rows))
+            copied += len(rows)
+    finally:
+        iterator.close()
+    return max_id, copied
+
+
+def _doc_ids(collection) -> set[str]:
+    doc_ids: set[str] = set()
+    iterator = collection.query_iterator(batch_size=_COPY_BATCH * 10, expr="id > 0", output_fields=["doc_id"])
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            doc_ids.update(row["doc_id"] for row in rows)
+    finally:
+        iterator.close()
+    return doc_ids
+
+
+def _delete_docs(collection, doc_ids: set[str]):
+    for doc_id in doc_ids:
+        collection.delete(expr=f'doc_id == "{doc_id}"')
+    collection.flush()
+
+
+def _search_keys(collection, vectors: list[list[float]], top_k: int) -> list[set[str]]:
+    results = collection.search(
+        data=vectors,
+        anns_field="vector",
+        param={"metric_type": "COSINE", "params": {"ef": max(config.HNSW_EF, top_k)}},
+        limit=top_k,
+        output_fields=["doc_id", "content"],
+    )
+    return [
+        {_row_key(hit.entity.get("doc_id"), hit.entity.get("content")) for hit in result_set}
+        for result_set in results
+    ]
+
+
+def _recall(src, dst, samples: list[tuple[list[float], list[float]]], top_k: int) -> float:
+    """以抽样 chunk 自身向量为查询，比较新旧 collection 的 top-k 命中重合度（recall@k）"""
+    if not samples:
+        return 1.0
+    src_keys = _search_keys(src, [s[0] for s in samples], top_k)
+    dst_keys = _search_keys(dst, [s[1] for s in samples], top_k)
+    overlaps = [len(a & b) / len(a) for a, b in zip(src_keys, dst_keys) if a]
+    return sum(overlaps) / len(overlaps) if overlaps else 1.0
+
+
+async def migrate_collection_dim(
+    model_provider: str,
+    target_dim: int,
+    mode: str = "truncate",
+    sample_size: int = 200,
+    top_k: int = 10,
+    min_recall: float = 0.9,
+    force: bool = False,
+    drop_old: bool = False,
+    kb: str | None = None,
+) -> dict:
+    """在线迁移到新的向量维度：
+
+    1. 新建 collection，逐批复制旧数据（mode="truncate" 截断并归一化旧向量；mode="reembed" 用新维度重新 embedding）
+    2. 建索引后补齐复制期间新写入的数据，抽样比较新旧 collection 的 recall@k
+    3. recall 达标（或 force）时原子切换逻辑名指向新 collection，再补齐一次并同步复制期间的删除
+    """
+    from pymilvus import Collection, utility
+
+    if mode not in ("truncate", "reembed"):
+        raise ValueError("mode 仅支持 truncate 或 reembed")
+    connect_milvus()
+    logical_name = get_collection_name(model_provider, kb)
+    src_name, src_dim = resolve_collection(model_provider, kb)
+    if not utility.has_collection(src_name):
+        raise ValueError(f"collection {src_name} 不存在")
+    if target_dim == src_dim:
+        raise ValueError(f"collection {src_name} 已经是 {target_dim} 维")
+    if mode == "truncate" and target_dim > src_dim:
+        raise ValueError("truncate 模式只能降低维度")
+
+    src = Collection(src_name)
+    dst_name = f"{logical_name}_d{target_dim}_{int(time.time())}"
+    dst = create_collection(dst_name, target_dim, build_index=False)
+
+    # 蓄水池抽样：(旧向量, 新向量)
+    rng = random.Random(0)
+    samples: list[tuple[list[float], list[float]]] = []
+    seen = 0
+
+    def sampler(row: dict, vector: list[float]):
+        nonlocal seen
+        seen += 1
+        item = ([float(v) for v in row["vector"]], vector)
+        if len(samples) < sample_size:
+            samples.append(item)
+        else:
+            j = rng.randrange(seen)
+            if j < sample_size:
+                samples[j] = item
+
+    start = time.monotonic()
+    last_id, copied = await _copy_rows(src, dst, model_provider, target_dim, mode, 0, sampler)
+    dst.flush()
+    build_collection_index(dst)
+
+    # 补齐复制期间写入旧 collection 的数据
+    last_id, caught_up = await _copy_rows(src, dst, model_provider, target_dim, mode, last_id, sampler)
+    dst.flush()
+
+    recall = _recall(src, dst, samples, top_k)
+    report = {
+        "kb": kb,
+        "source": src_name,
+        "source_dim": src_dim,
+        "target": dst_name,
+        "target_dim": target_dim,
+        "mode": mode,
+        "copied": copied + caught_up,
+        "recall_at_k": round(recall, 4),
+        "top_k": top_k,
+        "samples": len(samples),
+        "switched": False,
+    }
+    if recall < min_recall and not force:
+        report["message"] = f"recall@{top_k}={recall:.4f} 低于阈值 {min_recall}，未切换；新 collection 保留供检查"
+        return report
+
+    # 切换前同步复制期间在旧 collection 中删除的文档：此时新 collection 只含从旧 collection 复制的数据
+    src_docs = _doc_ids(src)
+    removed = _doc_ids(dst) - src_docs
+    _delete_docs(dst, removed)
+
+    # 原子切换：所有 worker 的后续检索 / 写入都指向新 collection
+    state_service.set_alias(logical_name, dst_name, target_dim)
+
+    # 切换瞬间仍在进行的写入 / 删除可能落到旧 collection，稍后再补齐一次。
+    # 只同步切换前已在旧 collection 中的文档，切换后直接写入新 collection 的文档不在旧 collection 中，不能删除
+    await asyncio.sleep(config.STATE_SYNC_INTERVAL * 2)
+    last_id, late = await _copy_rows(src, dst, model_provider, target_dim, mode, last_id, lambda *_: None)
+    late_removed = src_docs - _doc_ids(src)
+    _delete_docs(dst, late_removed)
+    removed |= late_removed
+
+    report.update({
+        "switched": True,
+        "copied": report["copied"] + late,
+        "removed_docs": len(removed),
+        "elapsed_s": round(time.monotonic() - start, 1),
+    })
+    if drop_old:
+        utility.drop_collection(src_name)
+        state_service.notify("collections")
+        report["dropped"] = src_name
+    return report
@@ -1,13 +1,13 @@
-from pymilvus import (
-    connections,
-    Collection,
-    CollectionSchema,
-    FieldSchema,
-    DataType,
-    utility,
-)
+from typing import TYPE_CHECKING
 import config
+from services import state_service, chunk_store_service
+from services.profile_service import traced
 
+# pymilvus 导入较重，延迟到首次使用时
+if TYPE_CHECKING:
+    from pymilvus import Collection
+
+# Milvus 连接是进程级资源，每个 worker 各自维护
 _connected = False
 
 
@@ -16,26 +16,75 @@ def connect_milvus():
     global _connected
     if _connected:
         return
+    from pymilvus import connections
+
     connections.connect(host=config.MILVUS_HOST, port=config.MILVUS_PORT)
     _connected = True
 
 
+# 本进程已调用过 load() 的 collection；Milvus 的加载状态可能被外部 release / 重启改变，
+# 因此不跨进程持久化，每个 worker 首次使用时各自 load()（幂等）。
+# 其他 worker 删除 collection 或切换别名时清空本地缓存
 _loaded_collections: set[str] = set()
+state_service.on_change("collections", _loaded_collections.clear)
 
 
-def get_or_create_collection(model_provider: str = "openai") -> Collection:
-    """获取或创建 collection"""
-    connect_milvus()
-    dim = config.EMBEDDING_DIM.get(model_provider, 1536)
-    collection_name = f"{config.MILVUS_COLLECTION}_{model_provider}"
+def get_collection_name(model_provider: str = "openai", kb: str | None = None) -> str:
+    """provider（及知识库）对应的逻辑 collection 名；kb 为空时为默认知识库"""
+    if kb:
+        return f"{config.MILVUS_COLLECTION}_kb_{kb}_{model_provider}"
+    return f"{config.MILVUS_COLLECTION}_{model_provider}"
+
+
+def _ensure_loaded(collection: "Collection"):
+    """确保 collection 已加载（每个进程首次使用时 load() 一次）"""
+    name = collection.name
+    if name in _loaded_collections:
+        return
+    collection.load()
+    _loaded_collections.add(name)
+
+
+def default_embedding_dim(model_provider: str = "openai") -> int:
+    """新建 collection 使用的向量维度：配置的降维维度优先，否则为模型原生维度"""
+    return config.EMBEDDING_DIMENSIONS.get(model_provider) or config.EMBEDDING_DIM.get(model_provider, 1536)
 
-    if utility.has_collection(collection_name):
-        collection = Collection(collection_name)
-        if collection_name not in _loaded_collections:
-            collection.load()
-            _loaded_collections.add(collection_name)
-        return collection
 
+# 物理 collection 的向量维度缓存（创建后不可变）
+_collection_dims: dict[str, int] = {}
+
+
+def _vector_dim(collection: "Collection") -> int:
+    for field in collection.schema.fields:
+        if field.name == "vector":
+            return int(field.params["dim"])
+    raise ValueError(f"collection {collection.name} 缺少 vector 字段")
+
+
+def resolve_collection(model_provider: str = "openai", kb: str | None = None) -> tuple[str, int]:
+    """返回当前生效的 (collection 名, 向量维度)；维度迁移 / 快照导入切换后指向新 collection"""
+    logical_name = get_collection_name(model_provider, kb)
+    alias = state_service.get_alias(logical_name)
+    if alias is not None:
+        return alias["collection"], alias["dim"]
+
+    dim = _collection_dims.get(logical_name)
+    if dim is None:
+        from pymilvus import Collection, utility
+
+        connect_milvus()
+        if not utility.has_collection(logical_name):
+            return logical_name, default_embedding_dim(model_provider)
+        dim = _vector_dim(Collection(logical_name))
+        _collection_dims[logical_name] = dim
+    return logical_name, dim
+
+
+def create_collection(collection_name: str, dim: int, build_index: bool = True) -> "Collection":
+    """按标准 schema 创建 collection；build_index=False 时由调用方在批量写入后再建索引"""
+    from pymilvus import Collection, CollectionSchema, FieldSchema, DataType
+
+    connect_milvus()
     fields = [
         FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
         FieldSchema(name="doc_id", dtype=DataType.VARCHAR, max_length=256),
@@ -44,8 +93,14 @@ def get_or_create_collection(model_provider: str = "openai") -> Collection:
     ]
     schema = CollectionSchema(fields=fields, description="RAG document chunks")
     collection = Collection(name=collection_name, schema=schema)
+    _collection_dims[collection_name] = dim
+    if build_index:
+        build_collection_index(collection)
+    return collection
+
 
-    # 创建 HNSW 索引
+def build_collection_index(collection: "Collection"):
+    """创建 HNSW 索引并加载 collection"""
     index_params = {
         "index_type": "HNSW",
         "metric_type": "COSINE",
@@ -56,13 +111,49 @@ def get_or_create_collection(model_provider: str = "openai") -> Collection:
     }
     collection.create_index(field_name="vector", index_params=index_params)
     collection.load()
-    _loaded_collections.add(collection_name)
-    return collection
+    _loaded_collections.add(collection.name)
+
+
+def get_or_create_collection(model_provider: str = "openai", kb: str | None = None) -> "Collection":
+    """获取或创建当前生效的 collection"""
+    from pymilvus import Collection, utility
+
+    connect_milvus()
+    collection_name, dim = resolve_collection(model_provider, kb)
+
+    if utility.has_collection(collection_name):
+        collection = Collection(collection_name)
+        _ensure_loaded(collection)
+        return collection
+
+    return create_collection(collection_name, dim)
+
+
+def warmup_collections(model_providers: list[str]):
+    """预热：连接 Milvus 并加载各 provider 的默认 collection 和全部知识库 collection（不存在时不创建）"""
+    from pymilvus import Collection, utility
+
+    connect_milvus()
+    targets = [(provider, None) for provider in model_providers]
+    targets += [(kb["model_provider"], kb["name"]) for kb in state_service.list_kbs()]
+    for provider, kb in targets:
+        collection_name, _ = resolve_collection(provider, kb)
+        if utility.has_collection(collection_name):
+            _ensure_loaded(Collection(collection_name))
 
 
-def insert_chunks(doc_id: str, chunks: list[str], vectors: list[list[float]], model_provider: str = "openai"):
-    """写入分块数据到 Milvus"""
-    collection = get_or_create_collection(model_provider)
+@traced("milvus.insert")
+def insert_chunks(
+    doc_id: str,
+    chunks: list[str],
+    vectors: list[list[float]],
+    model_provider: str = "openai",
+    kb: str | None = None,
+):
+    """写入分块数据到 Milvus（启用本地 chunk 存储时 content 只写引用）"""
+    collection = get_or_create_collection(model_provider, kb)
+    if config.CHUNK_STORE_ENABLED:
+        chunks = [chunk_store_service.make_ref(i) for i in chunk_store_service.append(chunks)]
     data = [
         [doc_id] * len(chunks),   # doc_id
         chunks,                    # content
@@ -72,53 +163,122 @@ def insert_chunks(doc_id: str, chunks: list[str], vectors: list[list[float]], mo
     collection.flush()
 
 
-def search_chunks(query_vector: list[float], model_provider: str = "openai", top_k: int = 5) -> list[dict]:
+def search_chunks(
+    query_vector: list[float],
+    model_provider: str = "openai",
+    top_k: int = 5,
+    kb: str | None = None,
+    with_vectors: bool = False,
+) -> list[dict]:
     """向量检索"""
-    collection = get_or_create_collection(model_provider)
+    return search_chunks_batch(
+        [query_vector], model_provider=model_provider, top_k=top_k, kb=kb, with_vectors=with_vectors
+    )[0]
+
+
+@traced("milvus.search")
+def search_chunks_batch(
+    query_vectors: list[list[float]],
+    model_provider: str = "openai",
+    top_k: int = 5,
+    kb: str | None = None,
+    with_vectors: bool = False,
+) -> list[list[dict]]:
+    """多向量检索：一次 search 调用（nq = len(query_vectors)），按输入顺序返回每条 query 的命中；
+    with_vectors=True 时命中结果附带 "vector"（供 MMR 等重排使用）"""
+    if not query_vectors:
+        return []
+    collection = get_or_create_collection(model_provider, kb)
     search_params = {
         "metric_type": "COSINE",
-        "params": {"ef": config.HNSW_EF},
+        "params": {"ef": max(config.HNSW_EF, top_k)},
     }
     results = collection.search(
-        data=[query_vector],
+        data=query_vectors,
         anns_field="vector",
         param=search_params,
         limit=top_k,
-        output_fields=["doc_id", "content"],
+        output_fields=["doc_id", "content", "vector"] if with_vectors else ["doc_id", "content"],
     )
 
-    hits = []
-    for result in results[0]:
-        hits.append({
-            "doc_id": result.entity.get("doc_id"),
-            "content": result.entity.get("content"),
-            "score": result.score,
-        })
-    return hits
+    all_hits = []
+    for result_set in results:
+        hits = []
+        for result in result_set:
+            hit = {
+                "id": result.id,
+                "doc_id": result.entity.get("doc_id"),
+                "content": result.entity.get("content"),
+                "score": result.score,
+            }
+            if with_vectors:
+                hit["vector"] = result.entity.get("vector")
+            hits.append(hit)
+        all_hits.append(chunk_store_service.hydrate(hits))
+    return all_hits
 
 
-def get_doc_chunk_count(doc_id: str, model_provider: str = "openai") -> int:
+def get_doc_chunk_count(doc_id: str, model_provider: str = "openai", kb: str | None = None) -> int:
     """获取某个文档的分块数量"""
-    collection = get_or_create_collection(model_provider)
+    collection = get_or_create_collection(model_provider, kb)
     expr = f'doc_id == "{doc_id}"'
     results = collection.query(expr=expr, output_fields=["doc_id"])
     return len(results)
 
 
-def get_doc_chunks(doc_id: str, model_provider: str = "openai") -> list[dict]:
+@traced("milvus.query")
+def get_doc_chunks(doc_id: str, model_provider: str = "openai", kb: str | None = None) -> list[dict]:
     """获取某个文档在 Milvus 中存储的完整记录"""
-    collection = get_or_create_collection(model_provider)
+    collection = get_or_create_collection(model_provider, kb)
     expr = f'doc_id == "{doc_id}"'
     results = collection.query(
         expr=expr,
         output_fields=["id", "doc_id", "content", "vector"],
     )
-    return results
+    return chunk_store_service.hydrate([dict(row) for row in results])
+
+
+def list_doc_ids(model_provider: str = "openai", kb: str | None = None) -> set[str]:
+    """列出 collection 中出现的全部 doc_id（collection 不存在时为空）"""
+    from pymilvus import Collection, utility
+
+    connect_milvus()
+    collection_name, _ = resolve_collection(model_provider, kb)
+    if not utility.has_collection(collection_name):
+        return set()
+    collection = Collection(collection_name)
+    _ensure_loaded(collection)
+    doc_ids: set[str] = set()
+    iterator = collection.query_iterator(batch_size=10000, expr="id > 0", output_fields=["doc_id"])
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            doc_ids.update(row["doc_id"] for row in rows)
+    finally:
+        iterator.close()
+    return doc_ids
 
 
-def delete_doc_chunks(doc_id: str, model_provider: str = "openai"):
+@traced("milvus.delete")
+def delete_doc_chunks(doc_id: str, model_provider: str = "openai", kb: str | None = None):
     """删除某个文档的所有分块"""
-    collection = get_or_create_collection(model_provider)
+    collection = get_or_create_collection(model_provider, kb)
     expr = f'doc_id == "{doc_id}"'
     collection.delete(expr=expr)
     collection.flush()
+
+
+def drop_kb_collections(model_provider: str, kb: str):
+    """删除知识库的 collection（含迁移 / 快照导入后生效的物理 collection）"""
+    from pymilvus import utility
+
+    connect_milvus()
+    names = {get_collection_name(model_provider, kb), resolve_collection(model_provider, kb)[0]}
+    for name in names:
+        if utility.has_collection(name):
+            utility.drop_collection(name)
+        _loaded_collections.discard(name)
+    state_service.delete_alias(get_collection_name(model_provider, kb))
+    state_service.notify("collections")
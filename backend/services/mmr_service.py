@@ -0,0 +1,46 @@
+import itertools
+
+
+def mmr_select(
+    query_vector: list[float],
+    candidate_vectors: list[list[float]],
+    k: int,
+    lambda_mult: float = 0.5,
+) -> list[int]:
+    """Maximal Marginal Relevance：从候选中选出 k 个兼顾相关性与多样性的结果，返回候选下标（按选择顺序）
+
+    score(i) = λ · sim(q, i) − (1 − λ) · max_{j∈已选} sim(i, j)，λ=1 退化为按相关性排序。
+    相关性是一次矩阵-向量乘法；每选一个结果只再算一次它与全部候选的相似度并更新最大值，
+    共 O(k · n · dim)，不构造 n × n 相似度矩阵。candidate_vectors 也可以直接传 (n, dim) ndarray。
+    """
+    import numpy as np
+
+    if isinstance(candidate_vectors, np.ndarray):
+        candidates = candidate_vectors.astype(np.float32, copy=False)
+    else:
+        # Milvus 返回的是 Python float 列表，转换（约 35ns / 元素）比 MMR 本身更耗时；
+        # fromiter 按已知长度直接写入 float32 缓冲区，省去嵌套 list 的形状推断
+        n = len(candidate_vectors)
+        dim = len(candidate_vectors[0]) if n else 0
+        candidates = np.fromiter(
+            itertools.chain.from_iterable(candidate_vectors), dtype=np.float32, count=n * dim
+        ).reshape(n, dim)
+    n = len(candidates)
+    k = min(k, n)
+    if k <= 0:
+        return []
+    # 余弦相似度：用范数缩放点积，避免复制整个候选矩阵做归一化
+    norms = np.maximum(np.sqrt(np.einsum("ij,ij->i", candidates, candidates)), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+
+    relevance = (candidates @ query) / (norms * max(float(np.linalg.norm(query)), 1e-12))
+    selected = [int(np.argmax(relevance))]
+    max_sim = (candidates @ candidates[selected[0]]) / (norms * norms[selected[0]])
+    weighted_relevance = lambda_mult * relevance
+    for _ in range(k - 1):
+        scores = weighted_relevance - (1 - lambda_mult) * max_sim
+        scores[selected] = -np.inf
+        idx = int(np.argmax(scores))
+        selected.append(idx)
+        np.maximum(max_sim, (candidates @ candidates[idx]) / (norms * norms[idx]), out=max_sim)
+    return selected
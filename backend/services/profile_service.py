@@ -0,0 +1,208 @@
+import functools
+import hmac
+import inspect
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from urllib.parse import parse_qs
+import config
+
+# 单请求 profiling：带管理员 token 的请求才会开启，未开启时 span 只做一次 contextvar 读取
+
+
+@dataclass
+class _Span:
+    name: str
+    start: float
+    end: float = 0.0
+
+
+@dataclass
+class _Session:
+    profile_id: str
+    method: str
+    path: str
+    started: float = field(default_factory=time.perf_counter)
+    spans: list[_Span] = field(default_factory=list)
+
+
+_session: ContextVar[_Session | None] = ContextVar("profile_session", default=None)
+
+
+@contextmanager
+def span(name: str):
+    """记录一段耗时（provider / Milvus 调用等），仅在当前请求开启 profiling 时生效"""
+    session = _session.get()
+    if session is None:
+        yield
+        return
+    item = _Span(name, time.perf_counter())
+    try:
+        yield
+    finally:
+        item.end = time.perf_counter()
+        session.spans.append(item)
+
+
+def traced(name: str):
+    """span 的装饰器形式，支持同步和 async 函数"""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def check_token(token: str | None) -> bool:
+    return bool(config.PROFILE_ADMIN_TOKEN) and bool(token) and hmac.compare_digest(token, config.PROFILE_ADMIN_TOKEN)
+
+
+def _request_token(scope) -> str | None:
+    for key, value in scope.get("headers", []):
+        if key == b"x-profile":
+            return value.decode("latin-1")
+    query = scope.get("query_string", b"")
+    if b"profile=" in query:
+        values = parse_qs(query.decode("latin-1")).get("profile")
+        return values[0] if values else None
+    return None
+
+
+def profile_path(profile_id: str) -> str:
+    return os.path.join(config.PROFILE_DIR, f"{profile_id}.speedscope.json")
+
+
+def _span_lanes(spans: list[_Span]) -> list[list[_Span]]:
+    """并发 span 会交叠，按区间嵌套关系分配到多条 lane，每条 lane 内严格嵌套"""
+    lanes: list[tuple[list[_Span], list[_Span]]] = []  # (lane 内 span, 当前打开的 span 栈)
+    for item in sorted(spans, key=lambda s: (s.start, -s.end)):
+        for members, stack in lanes:
+            while stack and stack[-1].end <= item.start:
+                stack.pop()
+            if not stack or item.end <= stack[-1].end:
+                members.append(item)
+                stack.append(item)
+                break
+        else:
+            lanes.append(([item], [item]))
+    return [members for members, _ in lanes]
+
+
+def _span_profiles(session: _Session, ended: float, frames: list[dict]) -> list[dict]:
+    """span 转为 speedscope evented profile（单位 ms，时间相对请求开始）"""
+    frame_index: dict[str, int] = {}
+    profiles = []
+
+    def _frame(name: str) -> int:
+        if name not in frame_index:
+            frame_index[name] = len(frames)
+            frames.append({"name": name})
+        return frame_index[name]
+
+    def _ms(t: float) -> float:
+        return round((t - session.started) * 1000, 3)
+
+    for lane, members in enumerate(_span_lanes(session.spans)):
+        events = []
+        for item in members:
+            events.append((_ms(item.start), 0, "O", _frame(item.name)))
+            events.append((_ms(item.end), 1, "C", _frame(item.name)))
+        # 同一时刻先关闭再打开；关闭顺序与打开相反
+        events.sort(key=lambda e: (e[0], e[1] == 0))
+        ordered = []
+        stack: list[int] = []
+        for at, _, kind, frame in events:
+            if kind == "O":
+                stack.append(frame)
+                ordered.append({"type": "O", "at": at, "frame": frame})
+            else:
+                ordered.append({"type": "C", "at": at, "frame": stack.pop()})
+        profiles.append({
+            "type": "evented",
+            "name": f"spans #{lane}",
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": _ms(ended),
+            "events": ordered,
+        })
+    return profiles
+
+
+def _write_profile(session: _Session, ended: float, sampled: str | None):
+    """写出 speedscope 文件：pyinstrument 采样结果（如有）+ span 时间线"""
+    if sampled:
+        document = json.loads(sampled)
+    else:
+        document = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": []},
+            "profiles": [],
+        }
+    document["name"] = f"{session.method} {session.path} ({session.profile_id})"
+    document["profiles"].extend(_span_profiles(session, ended, document["shared"]["frames"]))
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    tmp_path = f"{profile_path(session.profile_id)}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(document, f, ensure_ascii=False)
+    os.replace(tmp_path, profile_path(session.profile_id))
+
+
+def _start_sampler():
+    """pyinstrument 采样调用栈（已在 requirements 中；未安装时只记录 span）"""
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        return None
+    profiler = Profiler(interval=config.PROFILE_SAMPLE_INTERVAL, async_mode="enabled")
+    profiler.start()
+    return profiler
+
+
+class ProfileMiddleware:
+    """纯 ASGI middleware：请求带 X-Profile: <token> 头或 ?profile=<token> 时 profile 该请求，
+    响应头 X-Profile-Id 返回 profile id，文件通过 GET /api/profiles/{id} 下载"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not config.PROFILE_ADMIN_TOKEN or not check_token(_request_token(scope)):
+            await self.app(scope, receive, send)
+            return
+
+        session = _Session(profile_id=uuid.uuid4().hex[:12], method=scope["method"], path=scope["path"])
+        header = (b"x-profile-id", session.profile_id.encode())
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=[*message.get("headers", []), header])
+            await send(message)
+
+        token = _session.set(session)
+        profiler = _start_sampler()
+        try:
+            with span(f"{session.method} {session.path}"):
+                await self.app(scope, receive, send_with_id)
+        finally:
+            _session.reset(token)
+            ended = time.perf_counter()
+            sampled = None
+            if profiler is not None:
+                from pyinstrument.renderers import SpeedscopeRenderer
+
+                profiler.stop()
+                sampled = profiler.output(renderer=SpeedscopeRenderer())
+            _write_profile(session, ended, sampled)
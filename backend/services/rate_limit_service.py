@@ -0,0 +1,184 @@
+import asyncio
+import random
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any
+import config
+
+# 可重试的上游 HTTP 状态码
+_RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class ProviderRateLimitError(Exception):
+    """重试耗尽后仍被上游限流"""
+
+    def __init__(self, provider: str, retry_after: float | None = None):
+        super().__init__(f"{provider} 请求被限流，请稍后重试")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class _TokenBucket:
+    """按分钟配额匀速补充的令牌桶"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount: float):
+        # 单次请求超过整桶容量时按整桶计，避免永远等不到
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def drain(self):
+        """收到 429 时清空令牌，迫使后续请求按补充速率放行"""
+        self._refill()
+        self.tokens = 0.0
+
+
+class ProviderLimiter:
+    """单个 provider 的出站限流：RPM/TPM 令牌桶 + AIMD 自适应并发 + 带抖动的指数退避重试"""
+
+    def __init__(self, provider: str, rpm: int, tpm: int, max_concurrency: int):
+        self.provider = provider
+        self.requests = _TokenBucket(rpm)
+        self.tokens = _TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.limit = float(max(1, max_concurrency // 2))
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+        self._latency_ewma: float | None = None
+
+    async def _acquire(self, tokens: int):
+        async with self._cond:
+            while self.in_flight >= int(self.limit):
+                await self._cond.wait()
+            self.in_flight += 1
+        try:
+            await self.requests.acquire(1)
+            await self.tokens.acquire(tokens)
+        except BaseException:
+            await self._release()
+            raise
+
+    async def _release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _on_success(self, latency: float):
+        ewma = self._latency_ewma
+        self._latency_ewma = latency if ewma is None else 0.8 * ewma + 0.2 * latency
+        if ewma is not None and latency > config.RATE_LIMIT_LATENCY_FACTOR * ewma:
+            # 延迟明显升高：温和降低并发
+            self.limit = max(1.0, self.limit * 0.9)
+        else:
+            # 加性增：每个并发窗口约 +1
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+
+    def _on_throttled(self):
+        # 乘性减
+        self.limit = max(1.0, self.limit / 2)
+        self.requests.drain()
+
+    async def run(self, fn: Callable[[], Awaitable[Any]], tokens: int = 0) -> Any:
+        attempt = 0
+        while True:
+            await self._acquire(tokens)
+            start = time.monotonic()
+            try:
+                result = await fn()
+            except Exception as e:
+                status = _status_code(e)
+                if status is None and not _is_connection_error(e):
+                    raise
+                if status is not None and status not in _RETRYABLE_STATUS:
+                    raise
+                if status == 429:
+                    self._on_throttled()
+                retry_after = _retry_after(e)
+                if attempt >= config.RATE_LIMIT_MAX_RETRIES:
+                    if status == 429:
+                        raise ProviderRateLimitError(self.provider, retry_after) from e
+                    raise
+                delay = retry_after if retry_after is not None else _backoff(attempt)
+                attempt += 1
+            else:
+                self._on_success(time.monotonic() - start)
+                return result
+            finally:
+                await self._release()
+            await asyncio.sleep(delay)
+
+
+def _backoff(attempt: int) -> float:
+    """full jitter 指数退避"""
+    cap = min(config.RATE_LIMIT_BACKOFF_MAX, config.RATE_LIMIT_BACKOFF_BASE * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+def _status_code(e: Exception) -> int | None:
+    return getattr(e, "status_code", None)
+
+
+def _is_connection_error(e: Exception) -> bool:
+    from openai import APIConnectionError
+
+    return isinstance(e, APIConnectionError)
+
+
+def _retry_after(e: Exception) -> float | None:
+    """解析 Retry-After / retry-after-ms 响应头（秒）"""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def estimate_tokens(texts: list[str]) -> int:
+    """粗略估算 token 数（UTF-8 字节数 / 3，中文约 1 字 1 token，英文略偏高）"""
+    return sum(max(1, len(t.encode("utf-8")) // 3) for t in texts)
+
+
+_limiters: dict[str, ProviderLimiter] = {}
+
+
+def get_limiter(model_provider: str) -> ProviderLimiter:
+    """embedding_service / llm_service 共享的 provider 限流器（配额按 worker 数均分）"""
+    limiter = _limiters.get(model_provider)
+    if limiter is None:
+        limits = config.RATE_LIMITS.get(model_provider, config.RATE_LIMITS["openai"])
+        workers = config.WEB_CONCURRENCY
+        limiter = ProviderLimiter(
+            model_provider,
+            max(1, limits["rpm"] // workers),
+            max(1, limits["tpm"] // workers),
+            max(1, limits["max_concurrency"] // workers),
+        )
+        _limiters[model_provider] = limiter
+    return limiter
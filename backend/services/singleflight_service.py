@@ -0,0 +1,131 @@
+import asyncio
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Callable, Hashable
+from typing import Any
+
+
+class SingleFlight:
+    """相同 key 的并发调用只执行一次，其余调用方等待 leader 的结果"""
+
+    def __init__(self):
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            # 流水线放到独立 task 中执行，leader 请求被取消时不影响 follower
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t: self._forget(key, _t))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+
+class _StreamFlight:
+    """一次正在进行的流式调用：producer 写入事件，所有订阅者从头回放"""
+
+    def __init__(self):
+        self.events: list[Any] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.cond = asyncio.Condition()
+        self.task: asyncio.Task | None = None
+        self.subscribers = 0
+        self.cancelling = False
+
+    async def produce(self, gen_factory: Callable[[], AsyncIterator[Any]]):
+        try:
+            async for event in gen_factory():
+                async with self.cond:
+                    self.events.append(event)
+                    self.cond.notify_all()
+        except BaseException as e:
+            self.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            async with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def subscribe(self) -> "_Subscription":
+        # 调用时即登记订阅者：即使客户端在首次迭代前断开，aclose() 也会让计数归零并取消上游
+        self.subscribers += 1
+        return _Subscription(self)
+
+    async def _events(self) -> AsyncGenerator[Any, None]:
+        index = 0
+        while True:
+            async with self.cond:
+                while index >= len(self.events) and not self.done:
+                    await self.cond.wait()
+                pending = self.events[index:]
+                index = len(self.events)
+                finished = self.done
+            for event in pending:
+                yield event
+            if finished and index >= len(self.events):
+                break
+        if self.error is not None:
+            raise self.error
+
+    def release(self):
+        self.subscribers -= 1
+        # 最后一个订阅者离开（如客户端断开）时取消上游生成
+        if self.subscribers == 0 and not self.done and self.task is not None:
+            self.cancelling = True
+            self.task.cancel()
+
+
+class _Subscription:
+    """一个订阅者的事件迭代器；迭代结束或 aclose() 时注销（可重复调用）"""
+
+    def __init__(self, flight: _StreamFlight):
+        self._flight = flight
+        self._gen = flight._events()
+        self._released = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._gen.__anext__()
+        except BaseException:
+            self._release()
+            raise
+
+    async def aclose(self):
+        try:
+            await self._gen.aclose()
+        finally:
+            self._release()
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self._flight.release()
+
+
+class StreamSingleFlight:
+    """流式版本的 single-flight：相同 key 的并发请求共享同一个上游生成器"""
+
+    def __init__(self):
+        self._inflight: dict[Hashable, _StreamFlight] = {}
+
+    def subscribe(
+        self, key: Hashable, gen_factory: Callable[[], AsyncIterator[Any]]
+    ) -> _Subscription:
+        flight = self._inflight.get(key)
+        if flight is None or flight.cancelling:
+            flight = _StreamFlight()
+            self._inflight[key] = flight
+            flight.task = asyncio.ensure_future(flight.produce(gen_factory))
+            flight.task.add_done_callback(lambda _t: self._forget(key, flight))
+        return flight.subscribe()
+
+    def _forget(self, key: Hashable, flight: _StreamFlight):
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
@@ -0,0 +1,236 @@
+import json
+import os
+import shutil
+import time
+import config
+from services import state_service, chunk_store_service
+from services.milvus_service import (
+    build_collection_index,
+    connect_milvus,
+    create_collection,
+    get_collection_name,
+    resolve_collection,
+)
+
+# 快照格式：
+#   manifest.json   元信息（provider、维度、dtype、条数、索引参数）
+#   chunks.jsonl    每行一个 chunk：{"doc_id", "content"}，与向量按行对齐
+#   vectors.npy     (N, dim) float32 / float16 完整向量
+#   documents.json  文档注册表（仅该 provider / 知识库下已完成入库的文档）
+SNAPSHOT_VERSION = 1
+_EXPORT_BATCH = 1000
+
+
+class _VectorWriter:
+    """分批写入 .npy：先写原始数据，结束时补上带最终 shape 的 header"""
+
+    def __init__(self, path: str, dtype: str):
+        import numpy as np
+
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.raw_path = f"{path}.raw"
+        self._raw = open(self.raw_path, "wb")
+        self.rows = 0
+        self.dim: int | None = None
+
+    def write(self, vectors: list[list[float]]):
+        import numpy as np
+
+        array = np.asarray(vectors, dtype=self.dtype)
+        self.dim = array.shape[1]
+        self._raw.write(array.tobytes())
+        self.rows += array.shape[0]
+
+    def close(self):
+        import numpy as np
+
+        self._raw.close()
+        header = {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (self.rows, self.dim or 0)}
+        with open(self.path, "wb") as out, open(self.raw_path, "rb") as raw:
+            np.lib.format.write_array_header_1_0(out, header)
+            shutil.copyfileobj(raw, out, length=16 * 1024 * 1024)
+        os.remove(self.raw_path)
+
+
+def _iter_milvus_rows(model_provider: str, kb: str | None = None):
+    """按批读取当前 collection 的全部记录（含完整向量）"""
+    from pymilvus import Collection
+
+    connect_milvus()
+    collection_name, _ = resolve_collection(model_provider, kb)
+    iterator = Collection(collection_name).query_iterator(
+        batch_size=_EXPORT_BATCH,
+        expr="id > 0",
+        output_fields=["doc_id", "content", "vector"],
+    )
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            # 快照自包含：本地 chunk 存储的引用替换为文本
+            contents = chunk_store_service.resolve([row["content"] for row in rows])
+            yield [(row["doc_id"], content, row["vector"]) for row, content in zip(rows, contents)]
+    finally:
+        iterator.close()
+
+
+def _snapshot_documents(model_provider: str, kb: str | None) -> list[dict]:
+    """属于该 provider 和知识库（kb 为空时为默认知识库）且已完成入库的文档"""
+    return [
+        doc for doc in state_service.list_documents()
+        if doc.get("model_provider") == model_provider and doc.get("kb") == kb and doc.get("status") == "completed"
+    ]
+
+
+def _iter_chunk_result_rows(model_provider: str, chunk_results_dir: str, kb: str | None = None):
+    """从上传时保存的分块结果（JSON + 完整向量 .npy）读取，Milvus 不可用时使用"""
+    import numpy as np
+
+    for doc in _snapshot_documents(model_provider, kb):
+        if not doc.get("chunk_count"):
+            continue
+        doc_id = doc["doc_id"]
+        json_path = os.path.join(chunk_results_dir, f"{doc_id}.json")
+        npy_path = os.path.join(chunk_results_dir, f"{doc_id}.npy")
+        if not (os.path.exists(json_path) and os.path.exists(npy_path)):
+            raise FileNotFoundError(f"文档 {doc_id} 缺少分块结果或完整向量文件，请改用 Milvus 导出")
+        with open(json_path, "r", encoding="utf-8") as f:
+            chunks = json.load(f)["chunks"]
+        vectors = np.load(npy_path)
+        yield [(doc_id, chunk["content"], vector) for chunk, vector in zip(chunks, vectors)]
+
+
+def export_snapshot(
+    model_provider: str,
+    out_dir: str,
+    dtype: str = "float32",
+    source: str = "milvus",
+    chunk_results_dir: str | None = None,
+    kb: str | None = None,
+) -> dict:
+    """导出知识库快照（不调用任何模型）；kb 为空时导出默认知识库"""
+    if dtype not in ("float32", "float16"):
+        raise ValueError("dtype 仅支持 float32 或 float16")
+    if kb is not None and state_service.get_kb(kb) is None:
+        raise ValueError(f"知识库不存在: {kb}")
+    os.makedirs(out_dir, exist_ok=True)
+    collection_name, dim = resolve_collection(model_provider, kb)
+
+    if source == "milvus":
+        batches = _iter_milvus_rows(model_provider, kb)
+    elif source == "chunk_results":
+        batches = _iter_chunk_result_rows(model_provider, chunk_results_dir, kb)
+    else:
+        raise ValueError("source 仅支持 milvus 或 chunk_results")
+
+    writer = _VectorWriter(os.path.join(out_dir, "vectors.npy"), dtype)
+    with open(os.path.join(out_dir, "chunks.jsonl"), "w", encoding="utf-8") as f:
+        for batch in batches:
+            for doc_id, content, _ in batch:
+                f.write(json.dumps({"doc_id": doc_id, "content": content}, ensure_ascii=False) + "\n")
+            writer.write([vector for _, _, vector in batch])
+    writer.close()
+
+    documents = _snapshot_documents(model_provider, kb)
+    with open(os.path.join(out_dir, "documents.json"), "w", encoding="utf-8") as f:
+        json.dump(documents, f, ensure_ascii=False, indent=2)
+
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "model_provider": model_provider,
+        "kb": kb,
+        "source_collection": collection_name,
+        "dim": writer.dim or dim,
+        "dtype": dtype,
+        "count": writer.rows,
+        "documents": len(documents),
+        "index": {"type": "HNSW", "metric": "COSINE", "M": config.HNSW_M, "efConstruction": config.HNSW_EF_CONSTRUCTION},
+    }
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def import_snapshot(snapshot_dir: str, collection_name: str | None = None, switch: bool = True) -> dict:
+    """导入快照：新建 collection，大批量写入后只建一次索引，可选切换为当前生效 collection"""
+    import numpy as np
+
+    with open(os.path.join(snapshot_dir, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"不支持的快照版本: {manifest.get('version')}")
+
+    model_provider = manifest["model_provider"]
+    kb = manifest.get("kb")
+    dim = manifest["dim"]
+    if kb is not None:
+        kb_info = state_service.get_kb(kb)
+        if kb_info is None:
+            raise ValueError(f"知识库不存在: {kb}，请先以相同 model_provider 创建")
+        if kb_info["model_provider"] != model_provider:
+            raise ValueError(f"知识库 {kb} 的 model_provider 为 {kb_info['model_provider']}，与快照的 {model_provider} 不一致")
+    logical_name = get_collection_name(model_provider, kb)
+    collection_name = collection_name or f"{logical_name}_snap_{int(time.time())}"
+
+    start = time.monotonic()
+    vectors = np.load(os.path.join(snapshot_dir, "vectors.npy"), mmap_mode="r")
+    if vectors.shape != (manifest["count"], dim):
+        raise ValueError(f"vectors.npy 形状 {vectors.shape} 与 manifest 不一致")
+
+    collection = create_collection(collection_name, dim, build_index=False)
+    batch_size = config.SNAPSHOT_INSERT_BATCH
+    inserted = 0
+    doc_ids: list[str] = []
+    contents: list[str] = []
+
+    def _flush_batch():
+        nonlocal inserted
+        batch_vectors = np.asarray(vectors[inserted:inserted + len(doc_ids)], dtype=np.float32)
+        batch_contents = contents
+        if config.CHUNK_STORE_ENABLED:
+            batch_contents = [chunk_store_service.make_ref(i) for i in chunk_store_service.append(contents)]
+        collection.insert([doc_ids, batch_contents, batch_vectors.tolist()])
+        inserted += len(doc_ids)
+        doc_ids.clear()
+        contents.clear()
+
+    with open(os.path.join(snapshot_dir, "chunks.jsonl"), "r", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            doc_ids.append(row["doc_id"])
+            contents.append(row["content"])
+            if len(doc_ids) >= batch_size:
+                _flush_batch()
+    if doc_ids:
+        _flush_batch()
+    collection.flush()
+
+    # 全部写入后一次性建索引
+    build_collection_index(collection)
+
+    # 恢复文档注册表（已存在的保持不变）
+    documents_path = os.path.join(snapshot_dir, "documents.json")
+    restored = 0
+    if os.path.exists(documents_path):
+        with open(documents_path, "r", encoding="utf-8") as f:
+            for doc in json.load(f):
+                if state_service.get_document(doc["doc_id"]) is None:
+                    state_service.save_document(doc["doc_id"], doc)
+                    restored += 1
+
+    if switch:
+        state_service.set_alias(logical_name, collection_name, dim)
+
+    return {
+        "collection": collection_name,
+        "model_provider": model_provider,
+        "kb": kb,
+        "dim": dim,
+        "inserted": inserted,
+        "documents_restored": restored,
+        "switched": switch,
+        "elapsed_s": round(time.monotonic() - start, 1),
+    }
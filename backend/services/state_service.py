@@ -0,0 +1,187 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+import config
+
+# 多 worker / 多副本共享状态（同一主机）
+# 文档注册表、collection 别名和配置变更都存放在一个 SQLite（WAL）文件中，
+# 各 worker 通过 PRAGMA data_version 低成本感知其他进程的写入，再按版本号触发本地回调
+# （如重新加载 settings.json、清空本地 collection 缓存）。
+
+_lock = threading.Lock()
+_conn: sqlite3.Connection | None = None
+_data_version: int | None = None
+_seen_versions: dict[str, int] = {}
+_listeners: dict[str, list[Callable[[], None]]] = {}
+
+
+def _connect() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(config.STATE_DB_PATH), exist_ok=True)
+        conn = sqlite3.connect(config.STATE_DB_PATH, check_same_thread=False, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "doc_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS knowledge_bases ("
+            "name TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS collection_aliases ("
+            "alias TEXT PRIMARY KEY, collection TEXT NOT NULL, dim INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+        )
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def _bump(conn: sqlite3.Connection, name: str):
+    conn.execute(
+        "INSERT INTO versions (name, version) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET version = version + 1",
+        (name,),
+    )
+
+
+# --- 文档注册表 ---
+
+def save_document(doc_id: str, data: dict):
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO documents (doc_id, data, updated_at) VALUES (?, ?, ?)",
+            (doc_id, json.dumps(data, ensure_ascii=False), time.time()),
+        )
+        _bump(conn, "documents")
+        conn.commit()
+
+
+def get_document(doc_id: str) -> dict | None:
+    with _lock:
+        row = _connect().execute("SELECT data FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def list_documents() -> list[dict]:
+    with _lock:
+        rows = _connect().execute("SELECT data FROM documents ORDER BY rowid").fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def delete_document(doc_id: str) -> bool:
+    with _lock:
+        conn = _connect()
+        deleted = conn.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,)).rowcount > 0
+        _bump(conn, "documents")
+        conn.commit()
+    return deleted
+
+
+# --- 知识库 ---
+
+def save_kb(name: str, data: dict):
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO knowledge_bases (name, data, updated_at) VALUES (?, ?, ?)",
+            (name, json.dumps(data, ensure_ascii=False), time.time()),
+        )
+        _bump(conn, "knowledge_bases")
+        conn.commit()
+
+
+def get_kb(name: str) -> dict | None:
+    with _lock:
+        row = _connect().execute("SELECT data FROM knowledge_bases WHERE name = ?", (name,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def list_kbs() -> list[dict]:
+    with _lock:
+        rows = _connect().execute("SELECT data FROM knowledge_bases ORDER BY rowid").fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def delete_kb(name: str) -> bool:
+    with _lock:
+        conn = _connect()
+        deleted = conn.execute("DELETE FROM knowledge_bases WHERE name = ?", (name,)).rowcount > 0
+        _bump(conn, "knowledge_bases")
+        conn.commit()
+    return deleted
+
+
+# --- Collection 别名（逻辑名 -> 当前生效的物理 collection） ---
+
+def get_alias(alias: str) -> dict | None:
+    with _lock:
+        row = _connect().execute(
+            "SELECT collection, dim FROM collection_aliases WHERE alias = ?", (alias,)
+        ).fetchone()
+    return {"collection": row[0], "dim": row[1]} if row else None
+
+
+def set_alias(alias: str, collection: str, dim: int):
+    """原子切换逻辑名指向的 collection，所有 worker 的后续读写立即生效"""
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO collection_aliases (alias, collection, dim, updated_at) VALUES (?, ?, ?, ?)",
+            (alias, collection, dim, time.time()),
+        )
+        _bump(conn, "collections")
+        conn.commit()
+
+
+def delete_alias(alias: str):
+    with _lock:
+        conn = _connect()
+        conn.execute("DELETE FROM collection_aliases WHERE alias = ?", (alias,))
+        _bump(conn, "collections")
+        conn.commit()
+
+
+# --- 变更通知 ---
+
+def notify(name: str):
+    """标记某类共享状态已变更（如 settings），其他 worker 在下次 sync 时触发回调"""
+    with _lock:
+        conn = _connect()
+        _bump(conn, name)
+        conn.commit()
+
+
+def on_change(name: str, callback: Callable[[], None]):
+    """注册本进程的变更回调"""
+    _listeners.setdefault(name, []).append(callback)
+
+
+def sync():
+    """检查其他进程的写入并触发对应回调；无变更时只执行一次 PRAGMA data_version"""
+    global _data_version
+    with _lock:
+        conn = _connect()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == _data_version:
+            return
+        initial = _data_version is None
+        _data_version = data_version
+        versions = dict(conn.execute("SELECT name, version FROM versions").fetchall())
+
+    changed = [name for name, version in versions.items() if _seen_versions.get(name) != version]
+    for name in changed:
+        _seen_versions[name] = versions[name]
+        if initial:
+            # 首次同步只记录基线版本
+            continue
+        for callback in _listeners.get(name, []):
+            callback()
@@ -0,0 +1,78 @@
+import asyncio
+import time
+import traceback
+import config
+
+# 预热状态，供 /api/ready 查询
+_state = {
+    "ready": False,
+    "started_at": None,
+    "finished_at": None,
+    "steps": {},
+}
+
+
+def get_state() -> dict:
+    return dict(_state, steps=dict(_state["steps"]))
+
+
+def is_ready() -> bool:
+    return _state["ready"]
+
+
+def mark_ready():
+    _state["ready"] = True
+    _state["finished_at"] = time.time()
+
+
+def _provider_configured(model_provider: str) -> bool:
+    if model_provider == "bailian":
+        return bool(config.BAILIAN_API_KEY)
+    return bool(config.OPENAI_API_KEY)
+
+
+async def _run_step(name: str, fn, required: bool = False):
+    """执行一个预热步骤；required 步骤失败时按间隔重试直到成功"""
+    while True:
+        start = time.monotonic()
+        try:
+            await fn()
+            _state["steps"][name] = {"status": "ok", "elapsed_ms": round((time.monotonic() - start) * 1000)}
+            return
+        except Exception as e:
+            _state["steps"][name] = {"status": "error", "error": str(e)}
+            if not required:
+                return
+            traceback.print_exc()
+            await asyncio.sleep(config.WARMUP_RETRY_INTERVAL)
+
+
+async def run_warmup():
+    """启动预热：连接 Milvus 并加载 collection、加载 tokenizer、建立 provider 连接池"""
+    from services.chunk_service import get_encoding
+    from services.milvus_service import warmup_collections
+    from services import client_service
+
+    _state["started_at"] = time.time()
+    providers = config.WARMUP_PROVIDERS
+
+    async def _milvus():
+        await asyncio.to_thread(warmup_collections, providers)
+
+    async def _tokenizer():
+        await asyncio.to_thread(get_encoding)
+
+    async def _providers():
+        tasks = []
+        for provider in providers:
+            if _provider_configured(provider):
+                tasks.append(client_service.warmup_client(provider))
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=config.WARMUP_PROVIDER_TIMEOUT)
+
+    # Milvus 为必需依赖，连接失败会持续重试；provider 预热失败不阻塞就绪
+    await asyncio.gather(
+        _run_step("milvus", _milvus, required=True),
+        _run_step("tokenizer", _tokenizer),
+        _run_step("providers", _providers),
+    )
+    mark_ready()
@@ -0,0 +1,48 @@
+"""
+在线迁移 collection 的向量维度
+
+用法（在 backend 目录下执行）：
+    python -m tools.migrate_embedding_dim --provider openai --dim 512
+    python -m tools.migrate_embedding_dim --provider openai --dim 768 --mode reembed --min-recall 0.95
+    python -m tools.migrate_embedding_dim --provider openai --kb legal --dim 512
+"""
+import argparse
+import asyncio
+import json
+from services.migration_service import migrate_collection_dim
+
+
+def main():
+    parser = argparse.ArgumentParser(description="迁移 collection 到新的向量维度")
+    parser.add_argument("--provider", default="openai", choices=["openai", "bailian"])
+    parser.add_argument("--kb", help="知识库名（默认迁移默认知识库）")
+    parser.add_argument("--dim", type=int, required=True, help="目标维度")
+    parser.add_argument(
+        "--mode",
+        default="truncate",
+        choices=["truncate", "reembed"],
+        help="truncate: 截断并归一化已有向量（无模型调用）；reembed: 用新维度重新 embedding",
+    )
+    parser.add_argument("--sample-size", type=int, default=200, help="recall 对比的抽样数")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--min-recall", type=float, default=0.9, help="切换所需的最低 recall@k")
+    parser.add_argument("--force", action="store_true", help="recall 未达标也切换")
+    parser.add_argument("--drop-old", action="store_true", help="切换后删除旧 collection")
+    args = parser.parse_args()
+
+    report = asyncio.run(migrate_collection_dim(
+        model_provider=args.provider,
+        target_dim=args.dim,
+        mode=args.mode,
+        sample_size=args.sample_size,
+        top_k=args.top_k,
+        min_recall=args.min_recall,
+        force=args.force,
+        drop_old=args.drop_old,
+        kb=args.kb,
+    ))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
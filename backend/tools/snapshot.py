@@ -0,0 +1,53 @@
+"""
+知识库快照导出 / 导入（完整向量，无需重新 embedding）
+
+用法（在 backend 目录下执行）：
+    python -m tools.snapshot export --provider openai --out snapshots/openai-20260101
+    python -m tools.snapshot export --provider openai --out snap --dtype float16 --source chunk_results
+    python -m tools.snapshot export --provider openai --kb legal --out snapshots/legal-20260101
+    python -m tools.snapshot import --dir snapshots/openai-20260101
+"""
+import argparse
+import json
+import config
+from services.snapshot_service import export_snapshot, import_snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="知识库快照导出 / 导入")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    exp = sub.add_parser("export", help="导出快照")
+    exp.add_argument("--provider", default="openai", choices=["openai", "bailian"])
+    exp.add_argument("--kb", help="知识库名（默认导出默认知识库）")
+    exp.add_argument("--out", required=True, help="输出目录")
+    exp.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    exp.add_argument(
+        "--source",
+        default="milvus",
+        choices=["milvus", "chunk_results"],
+        help="milvus: 从当前 collection 读取；chunk_results: 从上传时保存的分块结果读取（Milvus 不可用时）",
+    )
+
+    imp = sub.add_parser("import", help="导入快照并重建索引")
+    imp.add_argument("--dir", required=True, help="快照目录")
+    imp.add_argument("--collection", help="新 collection 名（默认自动生成）")
+    imp.add_argument("--no-switch", action="store_true", help="导入后不切换为当前生效 collection")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        result = export_snapshot(
+            model_provider=args.provider,
+            out_dir=args.out,
+            dtype=args.dtype,
+            source=args.source,
+            chunk_results_dir=config.CHUNK_RESULTS_DIR,
+            kb=args.kb,
+        )
+    else:
+        result = import_snapshot(args.dir, collection_name=args.collection, switch=not args.no_switch)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+"""
+清理 Milvus 中的孤儿向量（doc_id 在文档注册表中不存在，通常是入库中途失败遗留）
+
+用法（在 backend 目录下执行）：
+    python -m tools.sweep_orphans --dry-run
+    python -m tools.sweep_orphans
+"""
+import argparse
+import json
+from services.ingest_service import sweep_orphans
+
+
+def main():
+    parser = argparse.ArgumentParser(description="清理 Milvus 中没有注册表记录的 doc_id")
+    parser.add_argument("--dry-run", action="store_true", help="只列出孤儿 doc_id，不删除")
+    args = parser.parse_args()
+
+    removed = sweep_orphans(dry_run=args.dry_run)
+    print(json.dumps({"dry_run": args.dry_run, "orphans": removed}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()